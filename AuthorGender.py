@@ -0,0 +1,129 @@
+import numpy as np
+import polars as pl
+from LibraryTree import GENDERS
+
+'''
+Tag MARC records with their author's gender as recorded in the VIAF. This is
+the linking done in Data/Author Gender Tagging.ipynb as a lazy polars
+pipeline: both VIAF-derived Parquet files are scanned rather than loaded,
+MARC author names are normalized with native string expressions, and the
+join and per-OCLC aggregation run on polars' streaming engine, which uses
+all cores (see POLARS_MAX_THREADS) within a bounded amount of memory.
+
+The files "author-name-index.parquet" and "author-genders.parquet" can be
+generated with the PIReT Book Data Tools (https://bookdata.piret.info/data/viaf.html)
+as described in Ekstrand, M. D., and Kluver, D. (2021). Exploring Author Gender
+in Book Rating and Recommendation. User Modeling and User-Adapted Interaction,
+31(3), 377–420.
+'''
+
+'''
+Link data from author-name-index.parquet and author-genders.parquet into
+unique (name, gender) pairs
+'''
+def scan_auth_gens(name_fp, gender_fp):
+    auth_name_idx = pl.scan_parquet(name_fp)
+    auth_gen = pl.scan_parquet(gender_fp)
+    joined = auth_name_idx.join(auth_gen, on='rec_id')
+    return joined.select(['name', 'gender']).unique()
+
+'''
+Preprocess names to match format in author-name-index.parquet. Mirrors
+process_name in the author gender notebook (and the name processing of
+Ekstrand & Kluver (2021)) with polars string expressions.
+'''
+def process_name(name):
+    return (name
+            # strip leading and trailing whitespace
+            .str.strip_chars()
+            # strip trailing punctuation
+            .str.strip_chars_end('.,_-()')
+            # remove remaining periods and square brackets
+            .str.replace_all('.', '', literal=True)
+            .str.replace_all(r'[\[\]]', '')
+            # remove dates
+            .str.replace_all(r',?( d|,d)? ?\d{4} ?-? ?\d{0,4}', '')
+            # remove trailing numbers
+            .str.replace(r' ?\d*$', '')
+            # deal with brackets
+            .str.replace_all(r' ?\([^)]*\)?', '')
+            # final strip
+            .str.strip_chars())
+
+'''
+Collect the OCLC number and main author of MARC records as a LazyFrame with
+columns 'oclc' and 'auth'. books can be a path to a Parquet file with those
+columns (auth being the first main author), a LazyFrame, or a list of book
+dicts (as stored in marcData.pk) whose 'auth' is a list of main authors.
+Records without an author are left out.
+'''
+def scan_marc_names(books):
+    if isinstance(books, str):
+        books = pl.scan_parquet(books)
+    elif isinstance(books, list):
+        with_auth = [book for book in books if book['auth'] != []]
+        books = pl.LazyFrame({'oclc': [book['oclc'] for book in with_auth],
+                              'auth': [book['auth'][0] for book in with_auth]},
+                             schema={'oclc': pl.Int64, 'auth': pl.String})
+    return (books.select(['oclc', 'auth'])
+            .filter(pl.col('auth').is_not_null())
+            .with_columns(process_name(pl.col('auth')).alias('name')))
+
+'''
+Tag each OCLC number with a gender from the genders listed in the VIAF
+records it is linked to, following get_gender_tag in the author gender
+notebook: a single gender if all linked records agree, the known gender
+if the others are unknown, and 'ambiguous' if both male and female are
+listed. Genders are coded as in LibraryTree.GENDERS.
+'''
+def gender_tags(linked):
+    known = pl.col('gender').filter(pl.col('gender') != 'unknown')
+    tagged = linked.group_by('oclc').agg(
+        pl.col('gender').n_unique().alias('num_gens'),
+        pl.col('gender').first().alias('first'),
+        known.n_unique().alias('num_known'),
+        known.first().alias('known'))
+    gender = (pl.when(pl.col('num_gens') == 1).then(pl.col('first'))
+              .when(pl.col('num_known') == 1).then(pl.col('known'))
+              .otherwise(pl.lit('ambiguous')))
+    codes = gender.replace_strict(GENDERS, list(range(len(GENDERS))),
+                                  return_dtype=pl.Int8)
+    return tagged.select(pl.col('oclc'), codes.alias('gender'))
+
+'''
+Build the author gender lookup as a lazy query: join the normalized MARC
+author names to the VIAF names and aggregate the linked genders per OCLC
+number.
+'''
+def scan_gender_lookup(books, name_fp, gender_fp):
+    names = scan_marc_names(books)
+    auth_gens = scan_auth_gens(name_fp, gender_fp)
+    linked = names.join(auth_gens, on='name', how='inner').select(['oclc', 'gender'])
+    return gender_tags(linked).sort('oclc')
+
+'''
+Build the author gender lookup and write it to a Parquet file with an int64
+'oclc' column and an int8 'gender' code column, sorted by OCLC number. The
+query is streamed straight to disk so the full tables are never held in
+memory.
+'''
+def write_gender_lookup(books, name_fp, gender_fp, out_fp):
+    scan_gender_lookup(books, name_fp, gender_fp).sink_parquet(out_fp)
+
+'''
+Load a lookup written by write_gender_lookup as a gender table (sorted
+OCLC numbers and gender codes) for ItemBias.lookup_genders and
+ItemBias.tag_books_batch.
+'''
+def load_gender_table(fp):
+    lookup = pl.read_parquet(fp, columns=['oclc', 'gender'])
+    return (lookup['oclc'].to_numpy().astype(np.int64),
+            lookup['gender'].to_numpy().astype(np.int8))
+
+'''
+Convert a gender table into the {oclc: gender} dict used by
+ItemBias.tag_books_fm (and stored in authorGender.pk)
+'''
+def to_lookup_dict(table):
+    oclcs, codes = table
+    return {int(oclc): GENDERS[code] for oclc, code in zip(oclcs, codes)}
@@ -0,0 +1,109 @@
+import numpy as np
+
+'''
+Vectorized versions of the statistics used in the category and item bias
+analyses. Every function works on a batch of samples at once: the first
+axis of each input indexes the sample (i.e. a bootstrap replicate or a
+permutation) and one value is returned per sample.
+
+Depths (levels) are small non-negative integers, so statistics that compare
+depth distributions are computed exactly from per-sample histograms.
+'''
+
+'''
+Count the occurrences of the codes 0..num_bins-1 in each row of a 2-D array
+of integer codes.
+'''
+def batch_hist(codes, num_bins):
+    codes = np.asarray(codes)
+    rows = codes.shape[0]
+    offsets = np.arange(rows)[:, None] * num_bins
+    counts = np.bincount((codes + offsets).ravel(), minlength=rows*num_bins)
+    return counts.reshape(rows, num_bins)
+
+'''
+Shuffle a 1-D array size times, returning one shuffle per row
+'''
+def batch_shuffle(rng, values, size):
+    return rng.permuted(np.tile(np.asarray(values), (size, 1)), axis=1)
+
+'''
+Mean of each row of a histogram over the values in levels
+'''
+def hist_mean(hist, levels):
+    hist = np.asarray(hist, dtype=np.float64)
+    return hist @ np.asarray(levels, dtype=np.float64) / hist.sum(axis=-1)
+
+'''
+Count, for every pair of items drawn from two histograms over the same
+sorted levels, the pairs where the second item is deeper and the pairs
+where the first item is deeper. Ties are not counted.
+'''
+def hist_deeper_pairs(hist1, hist2):
+    hist1 = np.asarray(hist1, dtype=np.float64)
+    hist2 = np.asarray(hist2, dtype=np.float64)
+    # number of items strictly shallower than each level
+    below1 = np.cumsum(hist1, axis=-1) - hist1
+    below2 = np.cumsum(hist2, axis=-1) - hist2
+    deeper2 = (hist2 * below1).sum(axis=-1)
+    deeper1 = (hist1 * below2).sum(axis=-1)
+    return deeper2, deeper1
+
+'''
+Exact probability that a randomly selected item from the second histogram
+is deeper than a randomly selected item from the first, given that they are
+not at the same depth. Matches the expected value of the sampling estimate
+in CategoryBias.prob_non_west_deeper (with hist1 western, hist2 non-western)
+and ItemBias.prob_non_west_deeper (with hist1 male, hist2 female).
+'''
+def hist_prob_deeper(hist1, hist2):
+    deeper2, deeper1 = hist_deeper_pairs(hist1, hist2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return deeper2 / (deeper2 + deeper1)
+
+'''
+Jensen-Shannon divergence (natural log) between the normalized rows of two
+histograms. Matches CategoryBias.get_jsd.
+'''
+def hist_jsd(hist1, hist2):
+    p = np.asarray(hist1, dtype=np.float64)
+    q = np.asarray(hist2, dtype=np.float64)
+    p = p / p.sum(axis=-1, keepdims=True)
+    q = q / q.sum(axis=-1, keepdims=True)
+    m = (p + q) / 2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        kl_p = np.where(p > 0, p * np.log(p / m), 0).sum(axis=-1)
+        kl_q = np.where(q > 0, q * np.log(q / m), 0).sum(axis=-1)
+    return (kl_p + kl_q) / 2
+
+'''
+Base 2 entropy of the normalized rows of a histogram. Empty rows have an
+entropy of 0 (as in ItemBias.calc_diff_in_dist).
+'''
+def hist_entropy(hist):
+    hist = np.asarray(hist, dtype=np.float64)
+    total = hist.sum(axis=-1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        p = hist / total
+        ent = -np.where(p > 0, p * np.log2(p), 0).sum(axis=-1)
+    return np.where(total[..., 0] > 0, ent, 0)
+
+'''
+Difference between the row means of two batches of samples
+'''
+def mean_gap(sample1, sample2):
+    return np.mean(sample1, axis=-1) - np.mean(sample2, axis=-1)
+
+'''
+Circulation rates for a batch of samples of nodes (or items). The last axis
+holds the columns num_items, num_in_circ, circ_year and total_circ
+(see Bootstrap.circ_columns). Returns the percentage of items in circulation, the
+percentage of circulating items taken out and the rate of circulation of
+circulating items (as in CategoryBias.get_anual_circ), stacked on the last axis.
+'''
+def circ_rates(sample):
+    sums = np.asarray(sample, dtype=np.float64).sum(axis=-2)
+    num_items, num_in_circ, circ_year, total = np.moveaxis(sums, -1, 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.stack((num_in_circ / num_items, circ_year / num_in_circ,
+                         total / circ_year), axis=-1)
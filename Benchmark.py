@@ -0,0 +1,224 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+import LibraryTree as lt
+import WesternTagging as wt
+import CategoryBias as cb
+import ItemBias as ib
+import BatchStats as bs
+import Synthetic as sy
+
+'''
+Benchmarks for the main stages of the analyses, run on synthetic catalogues
+(see Synthetic) so that they need no data beyond the LCC outlines and DDC
+files in the repository. Every stage is timed and its throughput and peak
+memory (the peak of memory allocated by Python while it runs, as traced by
+tracemalloc) are reported. Results can be saved as JSON and compared to a
+previous run to catch regressions.
+
+Run from the command line, i.e.
+    python Benchmark.py --sizes 10000 100000 --perms 1000 --save bench.json
+    python Benchmark.py --sizes 10000 100000 --compare bench.json
+'''
+
+FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Data', 'Library Data')
+
+'''
+Stages of the benchmark. Each stage function takes the state of the run 
+(a dict shared by all stages) and returns the number of units it processed.
+Stages can be rerun: books are removed from the trees before they are added.
+'''
+def build_lcc(state):
+    state['lcc'] = lt.LCCTree(os.path.join(state['folder'], 'LCC Outlines'))
+    return len(state['lcc'].get_index())
+
+def build_ddc(state):
+    state['ddc'] = lt.DDCTree(os.path.join(state['folder'], 'DDC'))
+    return len(state['ddc'].get_index())
+
+def generate(state):
+    state['books'] = sy.make_catalogue(state['lcc'], state['ddc'], state['size'],
+                                       seed=state['seed'])
+    return len(state['books'])
+
+def lcc_add_books(state):
+    state['lcc'].remove_books()
+    state['lcc'].add_books(state['books'])
+    return len(state['books'])
+
+def ddc_add_books(state):
+    state['ddc'].remove_books()
+    state['ddc'].add_books(state['books'])
+    return len(state['books'])
+
+def tag_tree_fm(state):
+    ib.tag_tree_fm(state['lcc'])
+    return state['lcc'].item_count
+
+def tag_lcc(state):
+    wt.tag_lcc(state['lcc'])
+    return len(state['lcc'].get_index())
+
+def parse_west_data(state):
+    west, nonwest = [], []
+    wt.parse_west_data(state['lcc'].root, True, west)
+    wt.parse_west_data(state['lcc'].root, False, nonwest)
+    return len(state['lcc'].get_index())
+
+def parse_west_view(state):
+    index = state['lcc'].get_index()
+    state['west'] = wt.parse_west_view(state['lcc'].root, True, index)
+    state['nonwest'] = wt.parse_west_view(state['lcc'].root, False, index)
+    return len(state['lcc'].get_index())
+
+def category_perm_test(state):
+    cb.joint_perm_test(state['west'], state['nonwest'], state['perms'], seed=state['seed'])
+    return state['perms']
+
+def item_perm_test(state):
+    levels, hist_f, hist_m = ib.depth_hists(state['lcc'])
+    diff = abs(float(bs.hist_mean(hist_f, levels) - bs.hist_mean(hist_m, levels)))
+    ib.mean_perm_test(levels, hist_f, hist_m, diff, state['perms'], seed=state['seed'])
+    prob = ib.prob_f_deeper(hist_f, hist_m)
+    ib.deeper_perm_test(hist_f, hist_m, prob, state['perms'], seed=state['seed'])
+    return 2 * state['perms']
+
+def circ_stats(state):
+    ib.circ_stats_by_gender(state['lcc'])
+    return state['lcc'].item_count
+
+'''
+Stages in the order they are run, as (name, unit, function, required stages)
+'''
+STAGES = [('build_lcc', 'nodes', build_lcc, []),
+          ('build_ddc', 'nodes', build_ddc, []),
+          ('generate', 'books', generate, ['build_lcc', 'build_ddc']),
+          ('lcc_add_books', 'books', lcc_add_books, ['generate']),
+          ('ddc_add_books', 'books', ddc_add_books, ['generate']),
+          ('tag_tree_fm', 'books', tag_tree_fm, ['lcc_add_books']),
+          ('tag_lcc', 'nodes', tag_lcc, ['build_lcc']),
+          ('parse_west_data', 'nodes', parse_west_data, ['lcc_add_books', 'tag_lcc']),
+          ('parse_west_view', 'nodes', parse_west_view, ['lcc_add_books', 'tag_lcc']),
+          ('category_perm_test', 'perms', category_perm_test, ['parse_west_view']),
+          ('item_perm_test', 'perms', item_perm_test, ['lcc_add_books']),
+          ('circ_stats', 'books', circ_stats, ['lcc_add_books'])]
+
+'''
+Collect the stages needed to run a list of stages (including the stages 
+themselves)
+'''
+def required_stages(stages):
+    requires = {name: reqs for name, _, _, reqs in STAGES}
+    needed = set()
+    todo = list(stages)
+    while todo:
+        name = todo.pop()
+        if name not in needed:
+            needed.add(name)
+            todo.extend(requires[name])
+    return needed
+
+'''
+Run one stage, returning its time (in seconds), the number of units it
+processed and its peak memory (in bytes, None if memory is not traced).
+Tracing memory slows Python code down, so when trace is True the stage is
+timed first and then rerun with tracemalloc to measure its peak memory.
+'''
+def run_stage(func, state, trace=True):
+    start = time.perf_counter()
+    units = func(state)
+    elapsed = time.perf_counter() - start
+    peak = None
+    if trace:
+        tracemalloc.start()
+        func(state)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return elapsed, units, peak
+
+'''
+Run every stage (or the stages named in stages) on a synthetic catalogue
+of each size in sizes. Stages that the named stages depend on are run 
+but not reported. Returns one result dict per stage and size.
+'''
+def run_benchmark(sizes, perms=1000, seed=0, stages=None, trace=True, folder=FOLDER):
+    if stages is None:
+        stages = [name for name, _, _, _ in STAGES]
+    needed = required_stages(stages)
+    results = []
+    for size in sizes:
+        state = {'folder': folder, 'size': size, 'perms': perms, 'seed': seed}
+        for name, unit, func, _ in STAGES:
+            if name not in needed:
+                continue
+            if name not in stages:
+                func(state)
+                continue
+            elapsed, units, peak = run_stage(func, state, trace)
+            results.append({'size': size, 'stage': name, 'seconds': elapsed,
+                            'units': units, 'unit': unit,
+                            'throughput': units / elapsed if elapsed > 0 else float('inf'),
+                            'peak_mb': None if peak is None else peak / 2**20})
+    return results
+
+'''
+Print benchmark results as a table
+'''
+def print_results(results, out=sys.stdout):
+    out.write(f"{'size':>10} {'stage':<20} {'seconds':>10} {'throughput':>18} {'peak MB':>10}\n")
+    for res in results:
+        peak = '' if res['peak_mb'] is None else f"{res['peak_mb']:.1f}"
+        rate = f"{res['throughput']:,.0f} {res['unit']}/s"
+        out.write(f"{res['size']:>10} {res['stage']:<20} {res['seconds']:>10.3f} "
+                  f"{rate:>18} {peak:>10}\n")
+
+'''
+Compare results to a baseline run. Stages that are slower than the
+baseline by more than a factor of tolerance are returned as regressions
+(size, stage, baseline seconds, seconds).
+'''
+def compare_results(results, baseline, tolerance=1.25):
+    base = {(res['size'], res['stage']): res['seconds'] for res in baseline}
+    regressions = []
+    for res in results:
+        key = (res['size'], res['stage'])
+        if key in base and res['seconds'] > tolerance * base[key]:
+            regressions.append((res['size'], res['stage'], base[key], res['seconds']))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the analyses on synthetic catalogues')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000],
+                        help='number of books in each synthetic catalogue')
+    parser.add_argument('--perms', type=int, default=1000, help='permutations per test')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stages', nargs='+', default=None,
+                        help='stages to run (default all): ' + ', '.join(stage[0] for stage in STAGES))
+    parser.add_argument('--no-trace', action='store_true',
+                        help='do not trace memory (faster, but no peak memory)')
+    parser.add_argument('--save', default=None, help='save results to a JSON file')
+    parser.add_argument('--compare', default=None, help='compare to results in a JSON file')
+    parser.add_argument('--tolerance', type=float, default=1.25,
+                        help='slowdown factor that counts as a regression')
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(args.sizes, args.perms, args.seed, args.stages, not args.no_trace)
+    print_results(results)
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare_results(results, baseline, args.tolerance)
+        for size, stage, before, after in regressions:
+            print(f'REGRESSION {stage} ({size} books): {before:.3f}s -> {after:.3f}s')
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
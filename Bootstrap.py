@@ -0,0 +1,143 @@
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+import BatchStats as bs
+from CategoryBias import get_field
+
+'''
+Bootstrap confidence intervals for the category and item bias metrics.
+Replicates are computed in batches: each batch draws the resamples for
+many replicates at once and evaluates the metric on all of them in one
+vectorized step. Blocks of replicates are spread over a pool of worker
+threads and the size of their batches is capped so that memory use is 
+bounded regardless of the number of replicates.
+'''
+
+# number of replicates drawn from each child of the seed
+SEED_BLOCK = 1000
+
+'''
+Entropy gap between the distribution of books by men and books by women
+across the subcategories of a node (as in ItemBias.calc_diff_in_dist).
+'''
+def entropy_gap(hist_f, hist_m):
+    return bs.hist_entropy(hist_m) - bs.hist_entropy(hist_f)
+
+'''
+Metrics that can be bootstrapped, stored as (kind, function) pairs.
+'values' metrics are evaluated on resampled values and 'hist' metrics on
+histograms of the resampled values. All metrics take one sample per group.
+- depth_gap: mean depth of group 1 minus mean depth of group 2
+- desc_gap: mean number of descendants of group 1 minus group 2
+- prob_deeper: probability that an item of group 2 is deeper than an item of group 1
+- jsd: Jensen-Shannon divergence between the depth distributions of two groups
+- entropy_gap: entropy of group 2 (men) minus entropy of group 1 (women) over
+  subcategory indices
+- circ_rates: percentage in circulation, percentage taken out and rate of
+  circulation of a single group of circulation columns (see circ_columns)
+'''
+METRICS = {'depth_gap': ('values', bs.mean_gap),
+           'desc_gap': ('values', bs.mean_gap),
+           'prob_deeper': ('hist', bs.hist_prob_deeper),
+           'jsd': ('hist', bs.hist_jsd),
+           'entropy_gap': ('hist', entropy_gap),
+           'circ_rates': ('values', bs.circ_rates)}
+
+'''
+Collect a field of the starting nodes of western and non-western node lists
+(dict lists or TaggedNodes views) as bootstrap groups.
+'''
+def node_groups(west, nonwest, field):
+    return np.array(get_field(west, field)), np.array(get_field(nonwest, field))
+
+'''
+Stack the circulation fields of the starting nodes in a list of tagged
+nodes into the columns used by the circ_rates metric.
+'''
+def circ_columns(nodes):
+    return np.array([get_field(nodes, field) for field in
+                     ['num_items', 'num_in_circ', 'circ_year', 'total_circ']]).T
+
+'''
+Collect the subcategory index of every book by a woman and every book by
+a man at a node, as groups for the entropy_gap metric.
+'''
+def child_groups(node):
+    num_f, num_m = [], []
+    for child in node.children.values():
+        if child is not None:
+            num_m.append(child.gen_counts[0])
+            num_f.append(child.gen_counts[1])
+    kids = np.arange(len(num_f))
+    return np.repeat(kids, num_f), np.repeat(kids, num_m)
+
+'''
+Draw one batch of bootstrap replicates. Values are resampled by drawing
+indices with replacement. Resampling n values with replacement and
+counting them is the same as drawing their histogram from a multinomial
+distribution, so histogram metrics draw the counts directly.
+'''
+def draw_batch(kind, stat, groups, size, rngs):
+    if kind == 'hist':
+        samples = [rng.multinomial(hist.sum(), hist / hist.sum(), size=size)
+                   for hist, rng in zip(groups, rngs)]
+    else:
+        samples = [group[rng.integers(0, len(group), size=(size, len(group)))]
+                   for group, rng in zip(groups, rngs)]
+    return stat(*samples)
+
+'''
+Draw a block of replicates from its own seed, in batches of at most batch
+replicates. Each group is resampled with its own generator, which is used
+in the same order whatever the batch size, so the replicates of a block do
+not depend on it.
+'''
+def draw_block(kind, stat, groups, size, batch, seed):
+    rngs = [np.random.default_rng(child) for child in seed.spawn(len(groups))]
+    results = []
+    done = 0
+    while done < size:
+        results.append(draw_batch(kind, stat, groups, min(batch, size - done), rngs))
+        done += batch
+    return np.concatenate(results)
+
+'''
+Compute a bootstrap confidence interval for a metric.
+- groups is a list of samples (i.e. western and non-western depths), each
+  of which is resampled independently. Rows of 2-D samples are resampled
+  as units.
+- metric is the name of a metric in METRICS or a (kind, function) pair
+- reps is the number of bootstrap replicates
+- alpha sets the coverage of the percentile interval (1 - alpha)
+- seed makes the replicates reproducible (independent of workers and batch):
+  each block of SEED_BLOCK replicates is drawn from its own child seed
+- workers is the number of threads that evaluate batches in parallel
+- max_cells caps the number of resampled values held by one batch
+Returns the estimate on the original data, the (lower, upper) interval and
+the array of replicates.
+'''
+def bootstrap(groups, metric, reps=10000, alpha=0.05, seed=None, workers=1,
+              batch=None, max_cells=2**24):
+    kind, stat = METRICS[metric] if isinstance(metric, str) else metric
+    groups = [np.asarray(group) for group in groups]
+    if kind == 'hist':
+        # histograms over the levels seen in any group
+        levels, codes = np.unique(np.concatenate(groups), return_inverse=True)
+        splits = np.cumsum([len(group) for group in groups])[:-1]
+        groups = [np.bincount(group_codes, minlength=len(levels))
+                  for group_codes in np.split(codes, splits)]
+        cells = len(groups) * len(levels)
+    else:
+        cells = sum(group.size for group in groups)
+    estimate = stat(*[group[None] for group in groups])[0]
+    if batch is None:
+        batch = max(1, min(reps, max_cells // max(cells, 1)))
+    sizes = [SEED_BLOCK] * (reps // SEED_BLOCK)
+    if reps % SEED_BLOCK:
+        sizes.append(reps % SEED_BLOCK)
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(lambda size, ss: draw_block(kind, stat, groups, size, batch, ss),
+                                sizes, seeds))
+    replicates = np.concatenate(results)
+    lower, upper = np.nanquantile(replicates, [alpha/2, 1 - alpha/2], axis=0)
+    return estimate, (lower, upper), replicates
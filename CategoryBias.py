@@ -3,11 +3,35 @@ import random
 import statistics as stats
 import numpy as np
 from scipy.spatial.distance import jensenshannon
+from WesternTagging import TaggedNodes, node_columns, domain_mask, start_matrix
+import BatchStats as bs
+import Instrument as inst
 
 '''
 Functions to aid in the analyses of western category bias in the LCC and DDC. 
 It is assumed that the nodes and trees being examined are LibraryTree objects. 
+Lists of tagged nodes can either be lists of dicts built with 
+WesternTagging.parse_west_data or TaggedNodes views built with 
+WesternTagging.parse_west_view.
+
+The permutation tests can be given a PermCache.PermStore (store) and a seed,
+in which case the null distribution is computed in batches and saved so that
+reruns, resumed runs and extended runs only compute missing permutations.
+'''
+
 '''
+Collect a field (i.e. 'depth', 'num_desc' or 'num_items') from a list of 
+tagged nodes. If start is True only the starting nodes (nodes whose parent
+is not tagged) are kept.
+'''
+def get_field(nodes, field, start=True):
+    if isinstance(nodes, TaggedNodes):
+        col = nodes[field]
+        if start:
+            col = col[nodes['start']]
+        return col.tolist()
+    return [node[field] for node in nodes if not start or node['parent'] is None 
+            or node['parent'].west is None]
 
 '''
 Compute the total number of categories (descendants and all) in 
@@ -26,34 +50,36 @@ Functions to compute the mean, median and mode percentage of items per node.
 '''
 def avg_items_per_node(nodes):
     # Sum up the items in the starting nodes to get the total number of items
-    total_items = sum([node['num_items'] for node in nodes if node['parent'] is None 
-                    or node['parent'].west is None])
+    total_items = sum(get_field(nodes, 'num_items'))
 
-    items_per_node = [node['num_items']/total_items for node in nodes]
+    items_per_node = [count/total_items for count in get_field(nodes, 'num_items', False)]
     return stats.mean(items_per_node)
 
 def median_items_per_node(nodes):
-    total_items = sum([node['num_items'] for node in nodes if node['parent'] is None 
-                    or node['parent'].west is None])
+    total_items = sum(get_field(nodes, 'num_items'))
 
-    items_per_node = [node['num_items']/total_items for node in nodes]
+    items_per_node = [count/total_items for count in get_field(nodes, 'num_items', False)]
     return stats.median(items_per_node)
 
 def mode_items_per_node(nodes):
-    total_items = sum([node['num_items'] for node in nodes if node['parent'] is None 
-                    or node['parent'].west is None])
+    total_items = sum(get_field(nodes, 'num_items'))
 
-    items_per_node = [node['num_items']/total_items for node in nodes]
+    items_per_node = [count/total_items for count in get_field(nodes, 'num_items', False)]
     return stats.mode(items_per_node)
 
 '''
 Permutation test to determine how likely the discrepancy between western
 and non-western categories is the result of chance.
 '''
-def category_perm_test(w_count, nw_count, permutations):
+@inst.timed('category.category_perm_test', inst.arg(2, 'permutations'))
+def category_perm_test(w_count, nw_count, permutations, store=None, seed=0):
     i, p_val = 0, 0
     total = w_count + nw_count
     diff = abs(w_count - nw_count)
+    if store is not None:
+        p_val, _ = store.run('category_perm_test', [total], count_null(total), 
+                             diff, permutations, seed)
+        return p_val
     while i < permutations:
         random_w, random_nw, j = 0, 0, 0
         while j < total:
@@ -70,6 +96,17 @@ def category_perm_test(w_count, nw_count, permutations):
         i += 1
     return p_val / permutations
 
+'''
+Batch version of the null distribution of category_perm_test: the number 
+of western nodes when each node is labelled with uniform probability is
+binomial.
+'''
+def count_null(total):
+    def draw(rng, size):
+        random_w = rng.binomial(total, 0.5, size)
+        return np.abs(2*random_w - total)
+    return draw
+
 
 '''
 LEVEL BIAS
@@ -87,12 +124,7 @@ def level_bias1(west, nonwest):
 Collect the starting depths from a list of categories
 '''
 def get_level_dist(nodes):
-    starting_nodes = [node for node in nodes if node['parent'] is None 
-                      or node['parent'].west is None]
-    levels = []
-    for node in starting_nodes:
-        levels.append(node['depth'])
-    return levels
+    return get_field(nodes, 'depth')
 
 '''
 Compute the Jensen-Shannon divergence between a distribution of western
@@ -109,7 +141,12 @@ Permutation test to determine how likely it is that the attested JSD
 between the disttributions of western and non-western category depths 
 is the result of chance.
 '''
-def level_perm_test1(levels, nw_start, exp_jsd, perms):
+@inst.timed('category.level_perm_test1', inst.arg(3, 'perms'))
+def level_perm_test1(levels, nw_start, exp_jsd, perms, store=None, seed=0):
+    if store is not None:
+        p_val, _ = store.run('level_perm_test1', [levels, nw_start], 
+                             jsd_null(levels, nw_start), exp_jsd, perms, seed)
+        return p_val
     p_val = 0
     for _ in range(perms):
         np.random.shuffle(levels)
@@ -120,20 +157,58 @@ def level_perm_test1(levels, nw_start, exp_jsd, perms):
             p_val += 1
     return p_val/ perms
 
+'''
+Batch versions of the null distributions of level_perm_test1 and
+level_perm_test2, for use with a PermCache.PermStore. Each returns a 
+function that computes the statistic for a batch of shuffles of the 
+levels. Probabilities are computed exactly from the depth histograms 
+rather than by sampling pairs of categories.
+'''
+def jsd_null(levels, nw_start):
+    uniq, codes = np.unique(levels, return_inverse=True)
+    def draw(rng, size):
+        shuffled = bs.batch_shuffle(rng, codes, size)
+        return bs.hist_jsd(bs.batch_hist(shuffled[:, :nw_start], len(uniq)),
+                           bs.batch_hist(shuffled[:, nw_start:], len(uniq)))
+    return draw
+
+def prob_deeper_null(levels, nw_start):
+    uniq, codes = np.unique(levels, return_inverse=True)
+    def draw(rng, size):
+        shuffled = bs.batch_shuffle(rng, codes, size)
+        nw_deeper = bs.hist_prob_deeper(bs.batch_hist(shuffled[:, :nw_start], len(uniq)),
+                                        bs.batch_hist(shuffled[:, nw_start:], len(uniq)))
+        return np.abs(nw_deeper - 0.50)
+    return draw
+
+'''
+Exact probability that a non-western category is deeper than a western 
+one (ignoring ties), from the depth histograms of the levels. The first
+nw_start levels are the depths of the western categories.
+'''
+def exact_prob_non_west_deeper(levels, nw_start):
+    uniq, codes = np.unique(levels, return_inverse=True)
+    w_hist = np.bincount(codes[:nw_start], minlength=len(uniq))
+    nw_hist = np.bincount(codes[nw_start:], minlength=len(uniq))
+    return float(bs.hist_prob_deeper(w_hist[None], nw_hist[None])[0])
+
 
 '''
 Function to compute statistics relevant to category level bias. Determines
 the probability that a non-western node is deeper in a category system than 
-a western one and the significance of this probability. 
-'''
-def level_bias2(west, nonwest, permTest=False, perms=0):
-    starting_w = [node['depth'] for node in west if node['parent'] is None 
-                        or node['parent'].west is None]
-    starting_nw = [node['depth'] for node in nonwest if node['parent'] is None 
-                        or node['parent'].west is None]
-    prob_nw = prob_non_west_deeper(starting_w, starting_nw, 10000)    
+a western one and the significance of this probability. With a store the
+probability is computed exactly, as it is for the permutations.
+'''
+def level_bias2(west, nonwest, permTest=False, perms=0, store=None, seed=0):
+    starting_w = get_field(west, 'depth')
+    starting_nw = get_field(nonwest, 'depth')
+    if store is not None:
+        prob_nw = exact_prob_non_west_deeper(starting_w + starting_nw, len(starting_w))
+    else:
+        prob_nw = prob_non_west_deeper(starting_w, starting_nw, 10000)    
     if permTest:
-        p_val = level_perm_test2(starting_w + starting_nw, len(starting_w), prob_nw, perms)
+        p_val = level_perm_test2(starting_w + starting_nw, len(starting_w), prob_nw, perms,
+                                 store, seed)
         return prob_nw, p_val
     else:
         return prob_nw, None
@@ -141,10 +216,18 @@ def level_bias2(west, nonwest, permTest=False, perms=0):
 '''
 Permutation test to determine if the probability of a non-western
 category node being deeper in the classification system than a 
-western category system is significant. 
+western category system is significant. With a store the permutations 
+use exact probabilities, so the observed probability is also computed 
+exactly from the levels (and exp_prob is ignored).
 '''
-def level_perm_test2(levels, nw_start, exp_prob, perms):
+@inst.timed('category.level_perm_test2', inst.arg(3, 'perms'))
+def level_perm_test2(levels, nw_start, exp_prob, perms, store=None, seed=0):
     exp_diff = abs(exp_prob - 0.50)
+    if store is not None:
+        exp_diff = abs(exact_prob_non_west_deeper(levels, nw_start) - 0.50)
+        p_val, _ = store.run('level_perm_test2', [levels, nw_start], 
+                             prob_deeper_null(levels, nw_start), exp_diff, perms, seed)
+        return p_val
     p_val = 0
     for _ in range(perms):
         np.random.shuffle(levels)
@@ -191,22 +274,19 @@ Functions to compute the mean, median, and mode percentage of items per
 starting node. 
 '''
 def mean_items_per_start(nodes):
-    start_items = [node['num_items'] for node in nodes if node['parent']
-                       is None or node['parent'].west is None]
+    start_items = get_field(nodes, 'num_items')
     total_items = sum(start_items)
     items_per_start = [count/total_items for count in start_items]
     return stats.mean(items_per_start)
 
 def median_items_per_start(nodes):
-    start_items = [node['num_items'] for node in nodes if node['parent']
-                       is None or node['parent'].west is None]
+    start_items = get_field(nodes, 'num_items')
     total_items = sum(start_items)
     items_per_start = [count/total_items for count in start_items]
     return stats.median(items_per_start)
 
 def mode_items_per_start(nodes):
-    start_items = [node['num_items'] for node in nodes if node['parent']
-                       is None or node['parent'].west is None]
+    start_items = get_field(nodes, 'num_items')
     total_items = sum(start_items)
     items_per_start = [count/total_items for count in start_items]
     return stats.mode(items_per_start)
@@ -215,8 +295,7 @@ def mode_items_per_start(nodes):
 Compute the mean number of descendants per starting node. 
 '''
 def avg_descendants(nodes):
-    start_nodes = [node['num_desc'] for node in nodes if node['parent']
-                       is None or node['parent'].west is None]
+    start_nodes = get_field(nodes, 'num_desc')
     return stats.mean(start_nodes), len(start_nodes)
 
 '''
@@ -224,14 +303,17 @@ Permutation test to determine the significance of the difference between
 the mean number of descendants per western node and the mean number of
 descendants per non-western node.
 '''
-def desc_perm_test(w_nodes, nw_nodes, perms):
-    w_kids = [node['num_desc'] for node in w_nodes if node['parent']
-                       is None or node['parent'].west is None]
-    nw_kids = [node['num_desc'] for node in nw_nodes if node['parent']
-                       is None or node['parent'].west is None]
+@inst.timed('category.desc_perm_test', inst.arg(2, 'perms'))
+def desc_perm_test(w_nodes, nw_nodes, perms, store=None, seed=0):
+    w_kids = get_field(w_nodes, 'num_desc')
+    nw_kids = get_field(nw_nodes, 'num_desc')
     observed_diff = abs(stats.mean(w_kids) - stats.mean(nw_kids))
     kid_counts = w_kids + nw_kids
     num_w = len(w_kids)
+    if store is not None:
+        p_val, _ = store.run('desc_perm_test', [kid_counts, num_w], 
+                             desc_null(kid_counts, num_w), observed_diff, perms, seed)
+        return p_val
     p_val, i = 0, 0
     while i < perms:
         np.random.shuffle(kid_counts)
@@ -243,6 +325,104 @@ def desc_perm_test(w_nodes, nw_nodes, perms):
         i += 1
     return p_val / perms
 
+'''
+Batch version of the null distribution of desc_perm_test
+'''
+def desc_null(kid_counts, num_w):
+    def draw(rng, size):
+        shuffled = bs.batch_shuffle(rng, kid_counts, size)
+        return np.abs(bs.mean_gap(shuffled[:, :num_w], shuffled[:, num_w:]))
+    return draw
+
+'''
+JOINT PERMUTATION TESTS
+
+Statistics that can be evaluated on a shared batch of permutations of the
+western and non-western starting node labels. Each takes the pooled fields
+of the starting nodes (western first), a batch of permutations of their 
+positions (one per row) and the number of western nodes. The first num_w
+positions of each row are labelled western.
+- count: difference in the number of categories (starting nodes and their
+  descendants) in western and non-western subtrees
+- jsd: divergence between the western and non-western depth distributions
+- prob_deeper: distance from 0.5 of the probability that a non-western
+  starting node is deeper than a western one
+- desc: difference in the mean number of descendants per starting node
+'''
+def count_stat(data, perms, num_w):
+    sizes = data['num_desc'][perms] + 1
+    return np.abs(sizes[:, :num_w].sum(axis=1) - sizes[:, num_w:].sum(axis=1))
+
+def jsd_stat(data, perms, num_w):
+    levels = data['levels'][perms]
+    num_levels = data['num_levels']
+    return bs.hist_jsd(bs.batch_hist(levels[:, :num_w], num_levels), 
+                       bs.batch_hist(levels[:, num_w:], num_levels))
+
+def prob_deeper_stat(data, perms, num_w):
+    levels = data['levels'][perms]
+    num_levels = data['num_levels']
+    nw_deeper = bs.hist_prob_deeper(bs.batch_hist(levels[:, :num_w], num_levels), 
+                                    bs.batch_hist(levels[:, num_w:], num_levels))
+    return np.abs(nw_deeper - 0.50)
+
+def desc_stat(data, perms, num_w):
+    kids = data['num_desc'][perms]
+    return np.abs(bs.mean_gap(kids[:, :num_w], kids[:, num_w:]))
+
+PERM_STATS = {'count': count_stat,
+              'jsd': jsd_stat,
+              'prob_deeper': prob_deeper_stat,
+              'desc': desc_stat}
+
+'''
+Permutation test of several statistics at once. One batch of permutations
+of the western/non-western labels of the starting nodes is drawn at a time 
+and every statistic in stats (names in PERM_STATS, default all) is evaluated 
+on it, so all statistics share the same null permutations. 
+
+Besides a p-value per statistic, p-values adjusted for testing several 
+statistics are computed with the single-step max-statistic method: each 
+statistic is standardized by the mean and standard deviation of its null 
+distribution and the observed standardized value of a statistic is compared 
+to the maximum standardized value over all statistics in each permutation.
+
+Returns dicts (keyed by statistic) of the observed values, p-values and 
+adjusted p-values.
+'''
+@inst.timed('category.joint_perm_test', inst.arg(2, 'perms'))
+def joint_perm_test(west, nonwest, perms, stats=None, seed=None, batch=1000, tol=1e-12):
+    if stats is None:
+        stats = list(PERM_STATS.keys())
+    depths = np.array(get_field(west, 'depth') + get_field(nonwest, 'depth'))
+    uniq, codes = np.unique(depths, return_inverse=True)
+    data = {'num_desc': np.array(get_field(west, 'num_desc') + get_field(nonwest, 'num_desc')),
+            'levels': codes,
+            'num_levels': len(uniq)}
+    num_w = len(get_field(west, 'depth'))
+    n = len(codes)
+    observed = np.array([PERM_STATS[stat](data, np.arange(n)[None], num_w)[0] 
+                         for stat in stats])
+    rng = np.random.default_rng(seed)
+    null = []
+    done = 0
+    while done < perms:
+        size = min(batch, perms - done)
+        shuffled = bs.batch_shuffle(rng, np.arange(n), size)
+        null.append(np.stack([PERM_STATS[stat](data, shuffled, num_w) for stat in stats], axis=1))
+        done += size
+    null = np.concatenate(null)
+    p_vals = (null >= observed - tol).mean(axis=0)
+    # max-statistic adjustment on standardized statistics
+    mean, std = null.mean(axis=0), null.std(axis=0)
+    std[std == 0] = 1
+    z_null = (null - mean) / std
+    z_obs = (observed - mean) / std
+    max_null = z_null.max(axis=1)
+    adj_p_vals = (max_null[:, None] >= z_obs - tol).mean(axis=0)
+    return (dict(zip(stats, observed)), dict(zip(stats, p_vals)), 
+            dict(zip(stats, adj_p_vals)))
+
 '''
 CIRCULATION
 
@@ -251,23 +431,153 @@ the percentgae of circulaitng books taken out, and the rate of circulation
 for the books taken out. 
 '''
 def get_anual_circ(nodeList):
-    total = 0
-    num_items = 0
-    num_in_circ = 0
-    circ_year = 0
-    for node in nodeList:
-        if node['parent'] is None or node['parent'].west is None:
-            for item in node['items']:
-                # total number of times books have been circulated
-                total += item['total_circ']
-                num_items += 1
-                # Number of books in circulation
-                if item['circ_status'] > 0:
-                    num_in_circ += 1
-                # Number of books that circulated in a year
-                if item['total_circ'] > 0:
-                    circ_year += 1
+    # circulation counts are aggregated per node as items are added,
+    # so only the starting nodes need to be visited
+    # total number of times books have been circulated
+    total = sum(get_field(nodeList, 'total_circ'))
+    num_items = sum(get_field(nodeList, 'num_items'))
+    # Number of books in circulation
+    num_in_circ = sum(get_field(nodeList, 'num_in_circ'))
+    # Number of books that circulated in a year
+    circ_year = sum(get_field(nodeList, 'circ_year'))
     percent_circ = num_in_circ/num_items # percentage of books in circulation
     taken_out = circ_year/num_in_circ # percentage of circulating books taken out
     circ_rate = total/circ_year # rate of circulation for circulating books
-    return num_items, percent_circ, taken_out, circ_rate
\ No newline at end of file
+    return num_items, percent_circ, taken_out, circ_rate
+
+'''
+SENSITIVITY TO THE TAGGING SCHEME
+
+Compute the category bias metrics for every tagging scheme in a tag matrix
+(see WesternTagging.tag_matrix) at once. Node columns are collected once
+and each metric is a masked reduction over the node x scheme masks of
+western and non-western nodes. roots restricts the analysis to the
+subtrees of a list of nodes (i.e. the history main classes).
+
+Returns a dict of arrays with one row per scheme; metrics computed for
+western and non-western nodes have a second axis (western, non-western).
+- num_nodes, num_start: number of tagged nodes and starting nodes
+- num_items: number of items in the starting nodes
+- items_per_node: mean percentage of items per node (avg_items_per_node)
+- mean_depth, mean_desc: mean depth and number of descendants of the 
+  starting nodes (level_bias1, avg_descendants)
+- jsd, prob_deeper: JSD between the starting depths and the probability
+  that a non-western starting node is deeper (level_bias2, exact)
+- circ: percentage in circulation, percentage taken out and rate of
+  circulation (get_anual_circ) on the last axis
+'''
+def scheme_metrics(tree, tags, roots=None):
+    index = tree.get_index()
+    _, columns = node_columns(index)
+    domain = np.ones(len(index), dtype=bool) if roots is None else domain_mask(index, roots)
+    starts = start_matrix(index, tags)
+    # node x scheme x (western, non-western) masks
+    tagged = np.stack((tags == 1, tags == 0), axis=-1) & domain[:, None, None]
+    start = tagged & starts[:, :, None]
+    tagged, start = tagged.astype(np.float64), start.astype(np.float64)
+    depth = columns['depth'].astype(np.float64)
+    num_items = columns['num_items'].astype(np.float64)
+    def start_sum(col):
+        return np.einsum('n,nsg->sg', np.asarray(col, dtype=np.float64), start)
+    num_nodes = tagged.sum(axis=0)
+    num_start = start.sum(axis=0)
+    items = start_sum(num_items)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        items_per_node = np.einsum('n,nsg->sg', num_items, tagged) / items / num_nodes
+        mean_depth = start_sum(depth) / num_start
+        mean_desc = start_sum(columns['num_desc']) / num_start
+    # depth histograms of the starting nodes
+    levels = np.eye(columns['depth'].max() + 1)[columns['depth']]
+    hists = np.einsum('nl,nsg->gsl', levels, start)
+    circ_sums = np.stack([items] + [start_sum(columns[field]) for field in 
+                                    ['num_in_circ', 'circ_year', 'total_circ']], axis=-1)
+    return {'num_nodes': num_nodes,
+            'num_start': num_start,
+            'num_items': items,
+            'items_per_node': items_per_node,
+            'mean_depth': mean_depth,
+            'mean_desc': mean_desc,
+            'jsd': bs.hist_jsd(hists[0], hists[1]),
+            'prob_deeper': bs.hist_prob_deeper(hists[0], hists[1]),
+            'circ': bs.circ_rates(circ_sums[..., None, :])}
+
+'''
+Statistics of joint_perm_test (see PERM_STATS) for every scheme and every 
+labelling in a batch. pool is the scheme x node mask of the starting nodes
+of each scheme and west the scheme x labelling x node mask of the nodes 
+labelled western. The sums needed (of the number of descendants and of the
+depth histograms) are a single product with the node features in data.
+Returns an array of scheme x labelling x statistic.
+'''
+def scheme_stats(data, pool, west, stats):
+    features = data['features']
+    w_sums = west.reshape(-1, len(features)).astype(np.float64) @ features
+    w_sums = w_sums.reshape(west.shape[:2] + (features.shape[1],))
+    nw_sums = (pool.astype(np.float64) @ features)[:, None] - w_sums
+    w_desc, w_hist = w_sums[..., 0], w_sums[..., 1:]
+    nw_desc, nw_hist = nw_sums[..., 0], nw_sums[..., 1:]
+    num_w, num_nw = w_hist.sum(axis=-1), nw_hist.sum(axis=-1)
+    values = {}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if 'count' in stats:
+            values['count'] = np.abs((w_desc + num_w) - (nw_desc + num_nw))
+        if 'jsd' in stats:
+            values['jsd'] = bs.hist_jsd(w_hist, nw_hist)
+        if 'prob_deeper' in stats:
+            values['prob_deeper'] = np.abs(bs.hist_prob_deeper(w_hist, nw_hist) - 0.50)
+        if 'desc' in stats:
+            values['desc'] = np.abs(w_desc / num_w - nw_desc / num_nw)
+    return np.stack([values[stat] for stat in stats], axis=-1)
+
+'''
+Run joint_perm_test for every tagging scheme in a tag matrix at once. The
+starting nodes of every scheme are held as a scheme x node mask and each 
+batch of permutations is drawn once for all schemes: every permutation is 
+an ordering of the nodes, and in each scheme the first nodes of its own 
+starting nodes in that ordering are labelled western (as many as it has 
+western starting nodes). Schemes that only differ in a few tags are thus
+compared on closely matched permutations. Returns a list with the 
+(observed, p-values, adjusted p-values) of each scheme.
+'''
+@inst.timed('category.scheme_perm_tests', inst.arg(2, 'perms'))
+def scheme_perm_tests(tree, tags, perms, roots=None, stats=None, seed=None, batch=1000, 
+                      tol=1e-12):
+    if stats is None:
+        stats = list(PERM_STATS.keys())
+    index = tree.get_index()
+    domain = np.ones(len(index), dtype=bool) if roots is None else domain_mask(index, roots)
+    # scheme x node masks of the starting nodes and the western starting nodes
+    pool = (start_matrix(index, tags) & domain[:, None]).T
+    west = pool & (tags.T == 1)
+    nodes = np.flatnonzero(pool.any(axis=0))
+    pool, west = pool[:, nodes], west[:, nodes]
+    uniq, codes = np.unique(index.depth[nodes], return_inverse=True)
+    # number of descendants and one-hot depth level of every node
+    data = {'features': np.column_stack((index.num_descendants()[nodes], 
+                                         np.eye(len(uniq))[codes]))}
+    num_w = west.sum(axis=1)
+    n = len(nodes)
+    observed = scheme_stats(data, pool, west[:, None], stats)[:, 0]
+    rng = np.random.default_rng(seed)
+    null = []
+    done = 0
+    while done < perms:
+        size = min(batch, perms - done)
+        order = bs.batch_shuffle(rng, np.arange(n), size)
+        in_pool = pool[:, order]
+        labelled = in_pool & (np.cumsum(in_pool, axis=-1, dtype=np.int32) <= num_w[:, None, None])
+        # back from the order of each permutation to the order of the nodes
+        labelled = np.take_along_axis(labelled, np.argsort(order, axis=1)[None], axis=-1)
+        null.append(scheme_stats(data, pool, labelled, stats))
+        done += size
+    null = np.concatenate(null, axis=1)
+    p_vals = (null >= observed[:, None] - tol).mean(axis=1)
+    # max-statistic adjustment on standardized statistics, per scheme
+    mean, std = null.mean(axis=1), null.std(axis=1)
+    std[std == 0] = 1
+    z_null = (null - mean[:, None]) / std[:, None]
+    z_obs = (observed - mean) / std
+    max_null = z_null.max(axis=-1)
+    adj_p_vals = (max_null[:, :, None] >= z_obs[:, None] - tol).mean(axis=1)
+    return [(dict(zip(stats, observed[k])), dict(zip(stats, p_vals[k])),
+             dict(zip(stats, adj_p_vals[k]))) for k in range(tags.shape[1])]
@@ -0,0 +1,139 @@
+import sys
+import time
+import argparse
+import numpy as np
+import polars as pl
+
+'''
+Load and aggregate the OhioLINK circulation data (OhioLinkCirc.fil). This
+is gatherCircStats and addCircStats in Data/OhioLINK Data Extraction.ipynb
+as a lazy polars query: the tab separated file is scanned with typed
+columns and aggregated per OCLC number with a group-by on polars'
+streaming engine, so files with tens of millions of rows are processed
+in chunks on all cores.
+
+Every row of the file is an item (a copy of a book). The columns used are
+- 1: the OCLC number of the item
+- 9: whether the item is in circulation (available for borrowing)
+- 10: the total number of times the item was borrowed
+- 11: the number of times the item was borrowed in the year (2007)
+
+Per OCLC number the aggregates are the number of copies, the number of
+copies in circulation, the total circulation and the annual circulation.
+They are returned as a table (sorted OCLC numbers and one column per
+aggregate) that MARC records are joined against in one vectorized step,
+i.e.
+    table = load_circ_table('OhioLinkCirc.fil')
+    missing = add_circ_stats(books, table)
+'''
+
+# positions of the columns used in OhioLinkCirc.fil
+CIRC_COLUMNS = {'oclc': 1, 'in_circ': 9, 'total_circ': 10, 'annual_circ': 11}
+STATS = ['copies', 'in_circ', 'total_circ', 'annual_circ']
+
+'''
+Scan the items of a circulation file as a LazyFrame with typed columns
+'oclc', 'in_circ', 'total_circ' and 'annual_circ'
+'''
+def scan_circ(fp):
+    items = pl.scan_csv(fp, separator='\t', has_header=False, quote_char=None,
+                        infer_schema=False, truncate_ragged_lines=True)
+    return items.select([pl.nth(i).str.strip_chars().cast(pl.Int64).alias(name)
+                         for name, i in CIRC_COLUMNS.items()])
+
+'''
+Aggregate items per OCLC number (gatherCircStats): the number of copies,
+the number of copies in circulation, the total circulation and the annual
+circulation, sorted by OCLC number
+'''
+def scan_circ_stats(items):
+    stats = items.group_by('oclc').agg(pl.len().cast(pl.Int64).alias('copies'),
+                                       pl.col('in_circ').sum(),
+                                       pl.col('total_circ').sum(),
+                                       pl.col('annual_circ').sum())
+    return stats.sort('oclc')
+
+'''
+Aggregate a circulation file and write the result to a Parquet file. The
+query is streamed straight to disk.
+'''
+def write_circ_stats(fp, out_fp):
+    scan_circ_stats(scan_circ(fp)).sink_parquet(out_fp)
+
+'''
+Load the aggregates of a circulation file (or of a Parquet file written by
+write_circ_stats) as a table: a dict of numpy columns sorted by 'oclc'
+'''
+def load_circ_table(fp):
+    if fp.endswith('.parquet'):
+        stats = pl.read_parquet(fp)
+    else:
+        stats = scan_circ_stats(scan_circ(fp)).collect(engine='streaming')
+    return {name: stats[name].to_numpy().astype(np.int64) for name in ['oclc'] + STATS}
+
+'''
+Join a column of OCLC numbers against a circulation table. Returns the
+position of each OCLC number in the table, or -1 if it is not in it.
+'''
+def lookup_circ(oclcs, table):
+    keys = table['oclc']
+    oclcs = np.asarray(oclcs, dtype=np.int64)
+    if len(keys) == 0:
+        return np.full(len(oclcs), -1, dtype=np.int64)
+    pos = np.minimum(np.searchsorted(keys, oclcs), len(keys) - 1)
+    return np.where(keys[pos] == oclcs, pos, -1)
+
+'''
+Circulation columns of the books with the given OCLC numbers, as stored on
+books by addCircStats: 'copies', 'total_circ' (the annual circulation) and
+'circ_status' (the number of copies in circulation). Books that are not
+in the table get 0 for every column. Also returns the mask of those books.
+'''
+def circ_columns(oclcs, table):
+    pos = lookup_circ(oclcs, table)
+    missing = pos == -1
+    columns = {}
+    for name, stat in [('copies', 'copies'), ('total_circ', 'annual_circ'),
+                       ('circ_status', 'in_circ')]:
+        columns[name] = np.where(missing, 0, table[stat][pos])
+    return columns, missing
+
+'''
+Add circulation columns to a columnar batch of MARC records (see
+MarcData.iter_batches). Returns the mask of records not in the table.
+'''
+def add_circ_columns(batch, table):
+    columns, missing = circ_columns(batch['oclc'], table)
+    batch.update(columns)
+    return missing
+
+'''
+Add circulation data to a list of book dicts (addCircStats). Books that
+are not in the table are left unchanged. Returns the mask of those books.
+'''
+def add_circ_stats(books, table):
+    oclcs = np.fromiter((book['oclc'] for book in books), dtype=np.int64, count=len(books))
+    columns, missing = circ_columns(oclcs, table)
+    copies = columns['copies'].tolist()
+    total_circ = columns['total_circ'].tolist()
+    circ_status = columns['circ_status'].tolist()
+    for i in np.flatnonzero(~missing).tolist():
+        book = books[i]
+        book['copies'] = copies[i]
+        book['total_circ'] = total_circ[i]
+        book['circ_status'] = circ_status[i]
+    return missing
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Aggregate OhioLINK circulation data per OCLC number')
+    parser.add_argument('circ', help='circulation file (i.e. OhioLinkCirc.fil)')
+    parser.add_argument('--out', required=True, help='Parquet file to write the aggregates to')
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    write_circ_stats(args.circ, args.out)
+    print(f'aggregated {args.circ} in {time.perf_counter() - start:.1f}s')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
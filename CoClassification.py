@@ -0,0 +1,166 @@
+import numpy as np
+import scipy.sparse as sp
+import Instrument as inst
+
+'''
+Co-classification of items in the LCC and the DDC. Items classified in
+both systems are counted in a sparse contingency matrix with a row per
+LCC node and a column per DDC node (in the preorder of the trees'
+TreeIndex layouts), so questions about how the categories of one system
+map onto the other are answered with matrix operations, i.e.
+    co = CoClassMatrix(lcc, ddc)
+    co.add_books(books)
+    # items in each LCC main class by DDC hundreds
+    counts, lcc_nodes, ddc_nodes = co.at_depth(1, 1)
+
+Items are counted at their deepest category in each system (direct).
+Subtree counts (an item counted at every ancestor of its categories) are
+given by multiplying with ancestor matrices: rollup = A_lcc @ direct @ A_ddc.T,
+where A[i, j] is 1 if node i is node j or one of its ancestors.
+'''
+
+'''
+Sparse ancestor matrix of a tree index: entry (i, j) is 1 if node i is
+node j or one of its ancestors. Built one level at a time by moving every
+node up to its parent.
+'''
+def ancestor_matrix(index):
+    n = len(index)
+    rows, cols = [], []
+    nodes = np.arange(n)
+    anc = nodes
+    while len(nodes) > 0:
+        rows.append(anc)
+        cols.append(nodes)
+        anc = index.parent[anc]
+        keep = anc >= 0
+        anc, nodes = anc[keep], nodes[keep]
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    return sp.csr_matrix((np.ones(len(rows), dtype=np.int64), (rows, cols)), shape=(n, n))
+
+'''
+Contingency matrix of the items classified in an LCC tree and a DDC tree.
+- direct is a CSR matrix of item counts by (deepest LCC category, deepest
+  DDC category)
+- num_items is the number of items counted and skipped the number not
+  classified in both systems
+'''
+class CoClassMatrix:
+    def __init__(self, lcc, ddc):
+        self.lcc = lcc
+        self.ddc = ddc
+        self.lcc_index = lcc.get_index()
+        self.ddc_index = ddc.get_index()
+        self.shape = (len(self.lcc_index), len(self.ddc_index))
+        self.direct = sp.csr_matrix(self.shape, dtype=np.int64)
+        self.num_items = 0
+        self.skipped = 0
+        # roll-ups and ancestor matrices, built on first use
+        self.rolled = None
+        self.ancestors = None
+
+    '''
+    Add items given as the positions of their deepest categories in each
+    tree's index (-1 for items not classified in a system)
+    '''
+    def add_positions(self, lcc_pos, ddc_pos):
+        lcc_pos = np.asarray(lcc_pos, dtype=np.int64)
+        ddc_pos = np.asarray(ddc_pos, dtype=np.int64)
+        with inst.timer('coclass.add', len(lcc_pos)):
+            keep = (lcc_pos >= 0) & (ddc_pos >= 0)
+            counts = sp.csr_matrix((np.ones(int(keep.sum()), dtype=np.int64),
+                                    (lcc_pos[keep], ddc_pos[keep])), shape=self.shape)
+            self.direct = self.direct + counts
+            self.num_items += int(keep.sum())
+            self.skipped += len(keep) - int(keep.sum())
+            self.rolled = None
+
+    '''
+    Add books that have been added to both trees (and so keep their
+    'lcc_cat' and 'ddc_cat' categories)
+    '''
+    def add_books(self, books):
+        lcc_pos = [-1 if book.get('lcc_cat') is None else self.lcc_index.position(book['lcc_cat'])
+                   for book in books]
+        ddc_pos = [-1 if book.get('ddc_cat') is None else self.ddc_index.position(book['ddc_cat'])
+                   for book in books]
+        self.add_positions(lcc_pos, ddc_pos)
+
+    '''
+    Add items given as columns of LCC and DDC numbers, classified with the
+    trees' classify methods (so the items do not need to be added to the
+    trees)
+    '''
+    def add_columns(self, lcc_nums, ddc_nums):
+        self.add_positions(self.lcc.classify(lcc_nums), self.ddc.classify(ddc_nums))
+
+    def ancestor_matrices(self):
+        if self.ancestors is None:
+            self.ancestors = (ancestor_matrix(self.lcc_index), ancestor_matrix(self.ddc_index))
+        return self.ancestors
+
+    '''
+    Item counts over subtrees: entry (i, j) is the number of items in both
+    the subtree of LCC node i and the subtree of DDC node j
+    '''
+    def rollup(self):
+        if self.rolled is None:
+            anc_lcc, anc_ddc = self.ancestor_matrices()
+            self.rolled = (anc_lcc @ self.direct @ anc_ddc.T).tocsr()
+        return self.rolled
+
+    '''
+    Subtree counts between the LCC nodes at one depth and the DDC nodes at
+    another (i.e. depth 1 for the LCC main classes and the DDC hundreds).
+    Returns the counts and the LCC and DDC nodes of its rows and columns.
+    '''
+    def at_depth(self, lcc_depth, ddc_depth):
+        rows = np.flatnonzero(self.lcc_index.depth == lcc_depth)
+        cols = np.flatnonzero(self.ddc_index.depth == ddc_depth)
+        counts = self.rollup()[rows][:, cols]
+        return (counts, [self.lcc_index.nodes[i] for i in rows],
+                [self.ddc_index.nodes[j] for j in cols])
+
+    '''
+    DDC categories of the items in the subtree of an LCC node (or LCC
+    categories of a DDC node), as (node, count) pairs from the most to the
+    least items. depth restricts the categories to one depth of the other
+    system.
+    '''
+    def profile(self, node, depth=None):
+        rolled = self.rollup()
+        if node.cat_key == 'lcc_cat':
+            counts, other = rolled.getrow(self.lcc_index.position(node)), self.ddc_index
+        else:
+            counts, other = rolled.getcol(self.ddc_index.position(node)).T.tocsr(), self.lcc_index
+        idx, vals = counts.indices, counts.data
+        if depth is not None:
+            keep = other.depth[idx] == depth
+            idx, vals = idx[keep], vals[keep]
+        order = np.lexsort((idx, -vals))
+        return [(other.nodes[i], int(v)) for i, v in zip(idx[order].tolist(), vals[order].tolist())]
+
+    '''
+    Align every LCC node with the DDC node at a depth holding the most of its
+    items (and vice versa if by_ddc is True). Returns the position of the
+    best match of every node (-1 for nodes without items at that depth), 
+    its count and the share of the node's items it holds (out of all the
+    items in the node's subtree, including those classified above depth in
+    the other system).
+    '''
+    def best_match(self, depth, by_ddc=False):
+        rolled = self.rollup()
+        if by_ddc:
+            rolled, other = rolled.T.tocsr(), self.lcc_index
+        else:
+            other = self.ddc_index
+        # items in the subtree of every node (the column of the other root)
+        totals = rolled[:, 0].toarray().ravel()
+        cols = np.flatnonzero(other.depth == depth)
+        counts = rolled[:, cols].tocsr()
+        best = np.asarray(counts.argmax(axis=1)).ravel()
+        best_count = np.asarray(counts.max(axis=1).todense()).ravel()
+        has_items = best_count > 0
+        match = np.where(has_items, cols[best], -1)
+        share = np.divide(best_count, totals, out=np.zeros(len(totals)), where=totals > 0)
+        return match, best_count, share
@@ -0,0 +1,273 @@
+import os
+import re
+import sys
+import time
+import pickle
+import asyncio
+import hashlib
+import argparse
+import urllib.error
+import urllib.request
+from bs4 import BeautifulSoup
+import LibraryTree as lt
+
+'''
+Collect fine-grained Dewey Decimal Classification (DDC) categories
+(categories past the decimal place) from the MDS table on LibraryThing.com.
+This is the crawl in Data/Dewey Scraper.ipynb as an importable module:
+pages are fetched concurrently by an asyncio fetch pool with bounded
+concurrency, a rate limit and retries, and every response is kept in an
+on-disk cache, so an interrupted crawl resumes where it stopped (pages
+already fetched are read from the cache) and extending the categories only
+fetches new pages. The output is the list of (number, name) pairs that
+DDCTree.load_fg_cats reads from ddc_fg.pk.
+
+Run from the command line, i.e.
+    python DeweyScraper.py --out "Data/Library Data/DDC/ddc_fg.pk" --cache ddc_cache
+The base URL can be pointed at a local stand-in server for testing.
+'''
+
+BASE_URL = 'https://www.librarything.com/mds'
+SUMMARIES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Data', 'Library Data',
+                         'DDC', 'ddc22-summaries-eng.txt')
+# HTTP status codes worth retrying
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+'''
+Extract the last row of the table containing DDC categories from a
+BeautifulSoup object representing the contents of a page (None if there
+is no table)
+'''
+def get_dewey(soup):
+    ddc = soup.find_all('table', class_="ddc")
+    if len(ddc) == 0:
+        return None
+    # extract all rows
+    rows = ddc[0].find_all('tr')
+    if len(rows) == 0:
+        return None
+    return rows[-1]
+
+'''
+Extract categories from a DDC table row with both a name and a number
+'''
+def get_data(ddc):
+    data = []
+    for dat in ddc.select('td'):
+        num = re.search(r"\d+(\.\d+)?", dat.get('onclick', ''))
+        name = dat.select('.word')
+        # if the category has both a name and a classification number
+        if num is not None and name != [] and not re.search('^-*$', name[0].get_text()):
+            data.append((num[0], name[0].get_text()))
+    return data
+
+'''
+Extract the (number, name) pairs of the categories on a page
+'''
+def parse_page(content):
+    ddc = get_dewey(BeautifulSoup(content, 'html.parser'))
+    if ddc is None:
+        return []
+    return get_data(ddc)
+
+'''
+Read the numbers of the DDC categories in the summaries (the first 3
+levels), which are the pages the crawl starts from
+'''
+def summary_numbers(fp=SUMMARIES):
+    return sorted(set(row[0] for row in lt.DDCTree.read_txt(fp)))
+
+'''
+On-disk cache of HTTP responses, one file per URL named by the hash of
+the URL. Files are written atomically so an interrupted crawl never
+leaves a partial response in the cache. Pages that do not exist are 
+recorded with an empty marker file (the hash followed by '.404').
+'''
+class ResponseCache:
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def path(self, url):
+        return os.path.join(self.folder, hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+    def get(self, url):
+        fp = self.path(url)
+        if not os.path.exists(fp):
+            return None
+        with open(fp, 'rb') as f:
+            return f.read()
+
+    def put(self, url, content):
+        fp = self.path(url)
+        tmp = fp + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(content)
+        os.replace(tmp, fp)
+        if os.path.exists(fp + '.404'):
+            os.remove(fp + '.404')
+
+    def is_missing(self, url):
+        return os.path.exists(self.path(url) + '.404')
+
+    def mark_missing(self, url):
+        open(self.path(url) + '.404', 'wb').close()
+
+'''
+Fetch pool for the crawl.
+- concurrency is the maximum number of requests in flight
+- rate is the maximum number of requests started per second (None for no limit)
+- retries is the number of times a failed request is retried, waiting
+  backoff * 2^attempt seconds before each retry
+- cache is an optional ResponseCache; cached pages (and pages cached as
+  missing) are not fetched again unless refresh is True
+Requests are made with urllib in worker threads. Pages that do not exist
+(404) are returned as None.
+'''
+class Fetcher:
+    def __init__(self, concurrency=8, rate=4.0, retries=3, backoff=1.0, timeout=30,
+                 cache=None, refresh=False, log=None):
+        self.concurrency = concurrency
+        self.interval = 0 if not rate else 1 / rate
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.cache = cache
+        self.refresh = refresh
+        self.log = log
+        self.num_fetched = 0
+        self.num_cached = 0
+        self.num_failed = 0
+        self.num_missing = 0
+
+    '''
+    Create the asyncio primitives (in the running event loop)
+    '''
+    def start(self):
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.rate_lock = asyncio.Lock()
+        self.next_start = 0.0
+
+    '''
+    Wait until the rate limit allows another request to start
+    '''
+    async def wait_turn(self):
+        async with self.rate_lock:
+            loop = asyncio.get_running_loop()
+            now = loop.time()
+            if self.next_start > now:
+                await asyncio.sleep(self.next_start - now)
+                now = self.next_start
+            self.next_start = now + self.interval
+
+    def get(self, url):
+        request = urllib.request.Request(url, headers={'User-Agent': 'ddc-scraper'})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return response.read()
+
+    async def fetch(self, url):
+        if self.cache is not None and not self.refresh:
+            content = self.cache.get(url)
+            if content is not None:
+                self.num_cached += 1
+                return content
+            if self.cache.is_missing(url):
+                self.num_cached += 1
+                self.num_missing += 1
+                return None
+        async with self.semaphore:
+            for attempt in range(self.retries + 1):
+                await self.wait_turn()
+                try:
+                    content = await asyncio.to_thread(self.get, url)
+                    break
+                except urllib.error.HTTPError as err:
+                    if err.code == 404:
+                        self.num_missing += 1
+                        if self.cache is not None:
+                            self.cache.mark_missing(url)
+                        return None
+                    if err.code not in RETRY_STATUS or attempt == self.retries:
+                        self.num_failed += 1
+                        raise
+                except (urllib.error.URLError, TimeoutError, ConnectionError):
+                    if attempt == self.retries:
+                        self.num_failed += 1
+                        raise
+                if self.log is not None:
+                    self.log.write(f'retrying {url} (attempt {attempt + 1})\n')
+                await asyncio.sleep(self.backoff * 2**attempt)
+        self.num_fetched += 1
+        if self.cache is not None:
+            self.cache.put(url, content)
+        return content
+
+'''
+Crawl the MDS table from the pages of the numbers in starts, following
+every category found on a page to its own page. Each page is fetched
+once. Returns the (number, name) pairs of the categories found, without
+duplicates, sorted by number.
+'''
+async def crawl(starts, base_url=BASE_URL, fetcher=None):
+    fetcher = Fetcher() if fetcher is None else fetcher
+    fetcher.start()
+    seen = set(starts)
+    found = set()
+    pending = {asyncio.create_task(fetcher.fetch(f'{base_url}/{num}')) for num in starts}
+    num_done = 0
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            content = task.result()
+            num_done += 1
+            if fetcher.log is not None and num_done % 1000 == 0:
+                fetcher.log.write(f'{num_done} pages done, {len(pending)} pending, '
+                                  f'{len(found)} categories\n')
+            if content is None:
+                continue
+            for num, name in parse_page(content):
+                found.add((num, name))
+                if num not in seen:
+                    seen.add(num)
+                    pending.add(asyncio.create_task(fetcher.fetch(f'{base_url}/{num}')))
+    return sorted(found, key=lambda x : (float(x[0]), x))
+
+'''
+Collect the fine-grained categories below every category in the DDC
+summaries
+'''
+def scrape_fg_cats(summaries=SUMMARIES, base_url=BASE_URL, fetcher=None):
+    return asyncio.run(crawl(summary_numbers(summaries), base_url, fetcher))
+
+'''
+Save categories in the format read by DDCTree.load_fg_cats
+'''
+def save_fg_cats(fp, fg_cats):
+    with open(fp, 'wb') as f:
+        pickle.dump(list(fg_cats), f)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Collect fine-grained DDC categories from LibraryThing')
+    parser.add_argument('--out', required=True, help='pickle file to write the categories to')
+    parser.add_argument('--summaries', default=SUMMARIES, help='DDC summaries (start pages)')
+    parser.add_argument('--base-url', default=BASE_URL)
+    parser.add_argument('--cache', default=None, help='folder for the response cache')
+    parser.add_argument('--refresh', action='store_true', help='fetch cached pages again')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--rate', type=float, default=4.0, help='requests per second (0 for no limit)')
+    parser.add_argument('--retries', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    cache = None if args.cache is None else ResponseCache(args.cache)
+    fetcher = Fetcher(args.concurrency, args.rate, args.retries, cache=cache,
+                      refresh=args.refresh, log=sys.stderr)
+    start = time.perf_counter()
+    fg_cats = scrape_fg_cats(args.summaries, args.base_url, fetcher)
+    save_fg_cats(args.out, fg_cats)
+    print(f'{len(fg_cats)} categories ({fetcher.num_fetched} pages fetched, '
+          f'{fetcher.num_cached} from cache, {fetcher.num_missing} missing) '
+          f'in {time.perf_counter() - start:.1f}s')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,182 @@
+import sys
+import json
+import time
+import functools
+
+'''
+Opt-in timing and counters for the slow parts of the analyses (reading
+and hashing the LCC outlines, adding books to the trees, tagging and
+permutation tests). Instrumentation is off by default and costs a single
+flag check per instrumented call when off; hot loops keep their counts in
+local variables and only record them once at the end.
+
+Turn it on with enable(), run the analyses and read STATS (or call
+log_stats() to write it out), i.e.
+    import Instrument as inst
+    inst.enable(log=sys.stderr)
+    tree = LCCTree(folder)
+    print(inst.STATS.summary())
+
+Timers record the total wall time, number of calls and number of items
+(books, permutations, rows...) of a stage, so the throughput of a stage is
+items / seconds. Counters record events such as hash table hits and misses.
+If a log stream is set, every timed call is also written to it as a JSON
+line (see log_line), which job schedulers can scrape.
+'''
+
+ENABLED = False
+# stream that JSON log lines are written to (None for no log)
+LOG = None
+
+'''
+Timers and counters recorded while instrumentation is on
+'''
+class Stats:
+    def __init__(self):
+        # name -> [seconds, calls, items]
+        self.timers = {}
+        # name -> count
+        self.counters = {}
+
+    def add_time(self, name, seconds, items=0):
+        timer = self.timers.setdefault(name, [0.0, 0, 0])
+        timer[0] += seconds
+        timer[1] += 1
+        timer[2] += items
+
+    def add_count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def reset(self):
+        self.timers = {}
+        self.counters = {}
+
+    '''
+    Summary of the stats as a dict: per timer the seconds, calls, items and
+    items per second, and the value of every counter
+    '''
+    def summary(self):
+        timers = {}
+        for name, (seconds, calls, items) in self.timers.items():
+            timers[name] = {'seconds': seconds, 'calls': calls, 'items': items,
+                            'rate': rate(items, seconds)}
+        return {'timers': timers, 'counters': dict(self.counters)}
+
+STATS = Stats()
+
+'''
+Items per second (None for stages that do not count items)
+'''
+def rate(items, seconds):
+    if items == 0 or seconds <= 0:
+        return None
+    return items / seconds
+
+'''
+Turn instrumentation on (or off with flag=False). log is an optional
+stream for JSON log lines.
+'''
+def enable(flag=True, log=None):
+    global ENABLED, LOG
+    ENABLED = flag
+    LOG = log
+
+def disable():
+    enable(False)
+
+'''
+Write a record as a JSON log line
+'''
+def log_line(record, out=None):
+    out = LOG if out is None else out
+    if out is not None:
+        out.write(json.dumps(record) + '\n')
+
+'''
+Record a count (only when instrumentation is on)
+'''
+def count(name, n=1):
+    if ENABLED:
+        STATS.add_count(name, n)
+
+'''
+Context manager timing a stage. Set the items attribute inside the block
+to record how many items it processed, i.e.
+    with timer('lcc.add_books') as t:
+        t.items = len(books)
+'''
+class Timer:
+    def __init__(self, name, items=0):
+        self.name = name
+        self.items = items
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        STATS.add_time(self.name, seconds, self.items)
+        if LOG is not None:
+            log_line({'event': 'timer', 'name': self.name, 'seconds': seconds,
+                      'items': self.items, 'rate': rate(self.items, seconds)})
+        return False
+
+'''
+Does nothing, so that instrumented code runs unchanged when instrumentation
+is off
+'''
+class NullTimer:
+    items = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+NULL_TIMER = NullTimer()
+
+def timer(name, items=0):
+    if ENABLED:
+        return Timer(name, items)
+    return NULL_TIMER
+
+'''
+Decorator timing every call of a function. items is an optional function
+of the call's arguments giving the number of items processed.
+'''
+def timed(name, items=None):
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+            with Timer(name, 0 if items is None else items(*args, **kwargs)):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+'''
+Item count for timed: the argument at position i (or keyword name) of a call,
+i.e. timed('perm_test', arg(2, 'perms'))
+'''
+def arg(i, name):
+    def get(*args, **kwargs):
+        return args[i] if len(args) > i else kwargs.get(name, 0)
+    return get
+
+'''
+Write every timer and counter as a JSON log line (to the log stream, or to
+stderr if none is set)
+'''
+def log_stats(out=None):
+    out = out if out is not None else (LOG if LOG is not None else sys.stderr)
+    summary = STATS.summary()
+    for name, timer_stats in summary['timers'].items():
+        log_line({'event': 'timer_total', 'name': name, **timer_stats}, out)
+    for name, value in summary['counters'].items():
+        log_line({'event': 'counter', 'name': name, 'value': value}, out)
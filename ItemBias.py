@@ -1,6 +1,10 @@
 import numpy as np
 import scipy
 import random
+import LibraryTree as lt
+import NodeQuery as nq
+import BatchStats as bs
+import Instrument as inst
 
 '''
 Functions to aid in the analyses of item gender bias in the LCC and DDC. 
@@ -8,32 +12,94 @@ It is assumed that the nodes and trees being examined are LibraryTree objects.
 '''
 
 '''
-Calculate the percentage of books by men and books by women 
-at a given node and its children.
-'''
-def get_prop_fm(node):
-    if node.item_count > 0:
-        authGens = [book['auth_gen'] for book in node.items]
-        node.prop_m = authGens.count('male') / node.item_count
-        node.prop_f = authGens.count('female') / node.item_count
-    for child in node.children.values():
-        if child is not None:
-            get_prop_fm(child)
+Count the books by authors of each gender at a given node and its children.
+Counts are kept up to date as books are added to a tree, so this is only 
+needed if books were tagged after being added. Each book is counted at its 
+deepest category and the counts are then summed over every subtree, which
+takes a single pass over the nodes and the items. 
+'''
+def get_prop_fm(node, index=None):
+    if index is None:
+        index = lt.TreeIndex(node)
+    codes = [lt.GENDER_CODES.get(book.get('auth_gen')) for book in node.items]
+    positions = [index.position(book[node.cat_key]) for book, code in zip(node.items, codes) 
+                 if code is not None]
+    codes = [code for code in codes if code is not None]
+    counts = np.zeros((len(index), len(lt.GENDERS)), dtype=np.int64)
+    np.add.at(counts, (positions, codes), 1)
+    counts = index.rollup(counts)
+    for sub_node, sub_counts in zip(index.nodes, counts.tolist()):
+        sub_node.gen_counts = sub_counts
 
 '''
 Determine the percentage of books by men and women at each
 category in a classification system.
 '''
+@inst.timed('item.tag_tree_fm', lambda tree: tree.item_count)
 def tag_tree_fm(tree):
-    get_prop_fm(tree.root)
+    get_prop_fm(tree.root, tree.get_index())
 
 '''
 Tag a book with its authors gender.
 '''
+@inst.timed('item.tag_books_fm', lambda books, *args: len(books))
 def tag_books_fm(books, genLookup):
     for book in books:
         book['auth_gen'] = genLookup[book['oclc']]
 
+'''
+Convert an author gender lookup ({oclc: gender}) into a table of sorted
+int64 OCLC numbers and their gender codes (see LibraryTree.GENDERS), which
+can be joined against a column of OCLC numbers in one vectorized step.
+'''
+def build_gender_table(genLookup):
+    oclcs = np.fromiter(genLookup.keys(), dtype=np.int64, count=len(genLookup))
+    codes = np.fromiter((lt.GENDER_CODES[gen] for gen in genLookup.values()), 
+                        dtype=np.int8, count=len(genLookup))
+    order = np.argsort(oclcs, kind='stable')
+    return oclcs[order], codes[order]
+
+'''
+Save and load a gender table in numpy's .npz format
+'''
+def save_gender_table(fp, table):
+    oclcs, codes = table
+    np.savez(fp, oclc=oclcs, gender=codes)
+
+def load_gender_table(fp):
+    with np.load(fp) as data:
+        return data['oclc'], data['gender']
+
+'''
+Join a column of OCLC numbers against a gender table. Returns the gender
+code of each OCLC number, or -1 if it is not in the table.
+'''
+def lookup_genders(oclcs, table):
+    keys, codes = table
+    oclcs = np.asarray(oclcs, dtype=np.int64)
+    if len(keys) == 0:
+        return np.full(len(oclcs), -1, dtype=np.int8)
+    pos = np.minimum(np.searchsorted(keys, oclcs), len(keys) - 1)
+    return np.where(keys[pos] == oclcs, codes[pos], -1).astype(np.int8)
+
+'''
+Tag a list of books with their author's gender using a gender table. 
+Returns the gender code column of the books (-1 if untagged), a mask of 
+the books without an author in their MARC record and a mask of the books 
+whose author is not in the table (VIAF). Only books with an author that 
+is in the table are tagged.
+'''
+@inst.timed('item.tag_books_batch', lambda books, *args: len(books))
+def tag_books_batch(books, table):
+    oclcs = np.fromiter((book['oclc'] for book in books), dtype=np.int64, count=len(books))
+    no_auth = np.fromiter((book['auth'] == [] for book in books), dtype=bool, count=len(books))
+    codes = lookup_genders(oclcs, table)
+    codes[no_auth] = -1
+    missing = (codes == -1) & ~no_auth
+    for i in np.flatnonzero(codes >= 0):
+        books[i]['auth_gen'] = lt.GENDERS[codes[i]]
+    return codes, no_auth, missing
+
 '''
 CIRCULATION
 
@@ -43,42 +109,205 @@ system that are by an author of gender 'gen' (gender is coded as 'male',
 VIAF author records and Ekstrand & Kluver (2021).)
 '''
 def get_circ_stats(tree, gen):
-    annual_circ = 0
-    in_circ = 0
-    annual_in_circ = 0
-    total = 0
-    for item in tree.root.items:
-        if item['auth_gen'] == gen:
-            annual_circ += item['total_circ']
-            if item['total_circ'] > 0:
-                annual_in_circ += 1
-            if item['circ_status'] > 0:
-                in_circ += 1
-            total += 1
-    return total, in_circ, annual_in_circ, annual_circ
+    stats = circ_stats_by_gender(tree)[gen]
+    return tuple(int(stat) for stat in stats)
+
+'''
+Collect the columns of a list of items used in the grouped statistics: 
+the gender code of each item (-1 if untagged), its total circulation and 
+its circulation status. If a tree index is given, the position of each 
+item's deepest category in the index is also collected ('node').
+'''
+def item_columns(items, index=None):
+    n = len(items)
+    columns = {'gender': np.fromiter((lt.GENDER_CODES.get(item.get('auth_gen'), -1) 
+                                      for item in items), dtype=np.int64, count=n),
+               'total_circ': np.fromiter((item.get('total_circ', 0) for item in items), 
+                                         dtype=np.int64, count=n),
+               'circ_status': np.fromiter((item.get('circ_status', 0) for item in items), 
+                                          dtype=np.int64, count=n)}
+    if index is not None:
+        cat_key = index.nodes[0].cat_key
+        columns['node'] = np.fromiter((index.position(item[cat_key]) for item in items),
+                                      dtype=np.int64, count=n)
+    return columns
+
+'''
+Compute circulation statistics for every gender code at once, optionally 
+broken down by further groupings of the items. 
+- gender, total_circ and circ_status are item columns (see item_columns)
+- groups is a list of (codes, num_codes) pairs giving a non-negative 
+  integer group for every item (i.e. from node_groups or west_groups)
+Items with a negative gender or group code are left out. Returns an array 
+of shape (4, number of genders, num_codes of each group...) holding the 
+total number of items, the number in circulation, the number taken out 
+in the year and the annual circulation (as in get_circ_stats).
+'''
+def grouped_circ_stats(gender, total_circ, circ_status, groups=()):
+    codes = [np.asarray(gender)] + [np.asarray(group) for group, _ in groups]
+    dims = (len(lt.GENDERS),) + tuple(num_codes for _, num_codes in groups)
+    keep = np.logical_and.reduce([code >= 0 for code in codes])
+    keys = np.ravel_multi_index([code[keep] for code in codes], dims)
+    total_circ = np.asarray(total_circ)[keep]
+    circ_status = np.asarray(circ_status)[keep]
+    size = int(np.prod(dims))
+    stats = [np.bincount(keys, minlength=size),
+             np.bincount(keys, weights=circ_status > 0, minlength=size),
+             np.bincount(keys, weights=total_circ > 0, minlength=size),
+             np.bincount(keys, weights=total_circ, minlength=size)]
+    return np.stack(stats).astype(np.int64).reshape((4,) + dims)
+
+'''
+Circulation statistics (as returned by get_circ_stats) for every gender
+in a tree, from a single pass over its items.
+'''
+@inst.timed('item.circ_stats_by_gender', lambda tree: tree.item_count)
+def circ_stats_by_gender(tree):
+    columns = item_columns(tree.root.items)
+    stats = grouped_circ_stats(columns['gender'], columns['total_circ'], 
+                               columns['circ_status'])
+    return {gen: stats[:, code] for code, gen in enumerate(lt.GENDERS)}
+
+'''
+Group items by their category at a given depth (i.e. depth 1 for the main
+classes). node_positions are the positions of the items' deepest categories 
+in a tree index. Items classified above the depth are grouped under their 
+own category. Returns the group codes, the number of groups and the nodes 
+the groups stand for.
+'''
+def node_groups(index, node_positions, depth=1):
+    anc = np.arange(len(index))
+    # move every node up to its ancestor at the given depth
+    for _ in range(int(index.depth.max()) - depth):
+        anc = np.where(index.depth[anc] > depth, index.parent[anc], anc)
+    uniq, codes = np.unique(anc[node_positions], return_inverse=True)
+    return codes, len(uniq), [index.nodes[i] for i in uniq]
+
+'''
+Group items by the west tag of their deepest category: 0 for untagged,
+1 for non-western and 2 for western. Returns the group codes and the 
+number of groups.
+'''
+def west_groups(index, node_positions):
+    tags = np.fromiter((-1 if node.west is None else int(node.west) for node in index.nodes),
+                       dtype=np.int64, count=len(index))
+    return tags[node_positions] + 1, 3
 
 '''
 LEVEL BIAS
 
+The level tests only depend on how many books by women and by men there 
+are at each depth, so they are computed on depth histograms. Shuffling the
+gender labels of the books and counting the books by women at each depth 
+is the same as drawing those counts from a multivariate hypergeometric 
+distribution, so each permutation is one draw whose cost does not depend 
+on the number of books.
+
+Collect the depth histograms of books by women and by men in a tree from 
+the gender counts of its nodes (the books classified directly at a node 
+are its counts minus the counts of its children). Returns the depths and 
+the number of books by women and by men at each depth.
+'''
+@inst.timed('item.depth_hists')
+def depth_hists(tree):
+    index = tree.get_index()
+    counts = np.array([node.gen_counts for node in index.nodes], dtype=np.int64)
+    direct = counts.copy()
+    np.subtract.at(direct, index.parent[1:], counts[1:])
+    hist_f = np.bincount(index.depth, weights=direct[:, 1]).astype(np.int64)
+    hist_m = np.bincount(index.depth, weights=direct[:, 0]).astype(np.int64)
+    return np.arange(len(hist_f)), hist_f, hist_m
+
+'''
+Convert a list of depths, where the first split depths are for books by
+women, into depth histograms.
+'''
+def split_hists(levels, split):
+    uniq, codes = np.unique(levels, return_inverse=True)
+    hist_f = np.bincount(codes[:split], minlength=len(uniq))
+    hist_m = np.bincount(codes[split:], minlength=len(uniq))
+    return uniq, hist_f, hist_m
+
+'''
+Draw the depth histograms of books by women and by men for a batch of
+permutations of the gender labels
+'''
+def permute_hists(rng, hist_f, hist_m, size):
+    totals = hist_f + hist_m
+    perm_f = rng.multivariate_hypergeometric(totals, int(hist_f.sum()), size=size)
+    return perm_f, totals - perm_f
+
+'''
+Exact probability that a randomly selected book by a woman is deeper than
+a randomly selected book by a man (ignoring ties), from depth histograms.
+'''
+def prob_f_deeper(hist_f, hist_m):
+    return float(bs.hist_prob_deeper(np.asarray(hist_m)[None], np.asarray(hist_f)[None])[0])
+
+'''
+Null distributions of the mean depth and deeper-probability tests, for 
+a batch of permutations
+'''
+def mean_diff_null(levels, hist_f, hist_m):
+    def draw(rng, size):
+        perm_f, perm_m = permute_hists(rng, hist_f, hist_m, size)
+        return np.abs(bs.hist_mean(perm_f, levels) - bs.hist_mean(perm_m, levels))
+    return draw
+
+def prob_deeper_null(hist_f, hist_m):
+    def draw(rng, size):
+        perm_f, perm_m = permute_hists(rng, hist_f, hist_m, size)
+        return np.abs(bs.hist_prob_deeper(perm_m, perm_f) - 0.50)
+    return draw
+
+'''
+Run a permutation test from a null distribution, either directly or 
+through a PermCache.PermStore.
+'''
+@inst.timed('item.hist_perm_test', inst.arg(4, 'perms'))
+def hist_perm_test(name, arrays, draw_null, observed, perms, store=None, seed=None, tol=1e-12):
+    if store is not None:
+        p_val, _ = store.run(name, arrays, draw_null, observed, perms, 
+                             0 if seed is None else seed, tol)
+        return p_val
+    null = draw_null(np.random.default_rng(seed), perms)
+    return float(np.mean(null >= observed - tol))
+
+'''
 Permutation test to determine the significance of the difference
 between the average depth of books by women and books by men 
-in a library classification system.
+in a library classification system, from depth histograms.
 '''
-def level_perm_test1(levels, split, expDiff, perms):
-    p_val = 0
-    for i in range(perms):
-        np.random.shuffle(levels)
-        fLevels = levels[:split]
-        mLevels = levels[split:]
-        actualDiff = abs(np.mean(fLevels) - np.mean(mLevels))
-        if actualDiff >= expDiff:
-            p_val += 1
-    return p_val / perms
+def mean_perm_test(levels, hist_f, hist_m, expDiff, perms, store=None, seed=None):
+    levels, hist_f, hist_m = np.asarray(levels), np.asarray(hist_f), np.asarray(hist_m)
+    return hist_perm_test('mean_perm_test', [levels, hist_f, hist_m], 
+                          mean_diff_null(levels, hist_f, hist_m), expDiff, perms, store, seed)
+
+'''
+Permutation test to compute the significance of the probability
+that a book by a women is categorized deeper than a book by a man,
+from depth histograms.
+'''
+def deeper_perm_test(hist_f, hist_m, expVal, perms, store=None, seed=None):
+    hist_f, hist_m = np.asarray(hist_f), np.asarray(hist_m)
+    return hist_perm_test('deeper_perm_test', [hist_f, hist_m], prob_deeper_null(hist_f, hist_m),
+                          abs(expVal - 0.50), perms, store, seed)
+
+'''
+Permutation test to determine the significance of the difference
+between the average depth of books by women and books by men 
+in a library classification system. The first split levels are the 
+depths of books by women.
+'''
+def level_perm_test1(levels, split, expDiff, perms, store=None, seed=None):
+    uniq, hist_f, hist_m = split_hists(levels, split)
+    return mean_perm_test(uniq, hist_f, hist_m, expDiff, perms, store, seed)
 
 '''
 Count the probability that a randomly selected book written by a women
 is categorized deeper in the category system than a book by a man
 '''
+@inst.timed('item.prob_non_west_deeper', inst.arg(2, 'perms'))
 def prob_non_west_deeper(fLevels, mLevels, perms):
     deeperF, deeperM = 0, 0
     for _ in range(perms):
@@ -93,20 +322,14 @@ def prob_non_west_deeper(fLevels, mLevels, perms):
 '''
 Permutation test to compute the significance of the probability
 that a book by a women is categorized deeper in a library
-classification system than a book by a man.
-'''
-def level_perm_test2(levels, split, expVal, perms):
-    p_val = 0
-    expDiff = abs(expVal - 0.50)
-    for _ in range(perms):
-        np.random.shuffle(levels)
-        fLevels = levels[:split]
-        mLevels = levels[split:]
-        deeperF = prob_non_west_deeper(fLevels, mLevels, 10000)
-        actualDiff = abs(deeperF - 0.50)
-        if actualDiff >= expDiff:
-            p_val += 1
-    return p_val / perms
+classification system than a book by a man. The probability for each 
+permutation is computed exactly rather than from sampled pairs of books,
+so the observed probability is computed exactly from the same histograms
+(expVal, a sampled estimate, is ignored and kept for compatibility).
+'''
+def level_perm_test2(levels, split, expVal, perms, store=None, seed=None):
+    _, hist_f, hist_m = split_hists(levels, split)
+    return deeper_perm_test(hist_f, hist_m, prob_f_deeper(hist_f, hist_m), perms, store, seed)
 
 
 '''
@@ -120,8 +343,7 @@ def get_fm_dist(root):
     sum_f, sum_m = 0, 0
     for child in root.children.values():
         if child is not None:
-            num_f = int(child.item_count * child.prop_f)
-            num_m = int(child.item_count * child.prop_m)
+            num_m, num_f = child.gen_counts[0], child.gen_counts[1]
             dist_f.append(num_f)
             dist_m.append(num_m)
             sum_f +=  num_f
@@ -137,22 +359,12 @@ def get_fm_dist(root):
 Collect all nodes with at least minItems books and at least
 minKids children. 
 '''
+@inst.timed('item.nodes_with_constraints')
 def nodes_with_constraints(tree, minItems, minKids):
-    nodes = []
-    check_node(tree.root, minItems, minKids, nodes)
+    table = nq.NodeTable(tree)
     # not counting the root in this analyses
-    return nodes[1:]
-
-'''
-Helper function for nodes_with_constraints
-'''
-def check_node(node, minItems, minKids, nodeList):
-    num_children = node.count_children()
-    if node.item_count >= minItems and num_children >= minKids: 
-        nodeList.append(node)
-    for kid in node.children.values():
-        if kid is not None:
-            check_node(kid, minItems, minKids, nodeList)
+    mask = table.query((nq.ITEMS >= minItems) & (nq.KIDS >= minKids) & ~nq.is_root())
+    return table.nodes(mask)
 
 '''
 Code to determine the number of times the distribution of books by women
@@ -161,6 +373,7 @@ the number of times the distribution of men is flatter, and the number of times
 are equally as flat. Assumes that all nodes in the list of nodes have at least 
 2 children.
 '''
+@inst.timed('item.calc_dist_bias', lambda validNodes: len(validNodes))
 def calc_dist_bias(validNodes):
     flatter = [0, 0]
     for node in validNodes:
@@ -182,6 +395,7 @@ def calc_dist_bias(validNodes):
 Collect the differences in distributions of books by men versus books
 by women for all nodes in a list of nodes. 
 '''
+@inst.timed('item.calc_diff_in_dist', lambda validNodes: len(validNodes))
 def calc_diff_in_dist(validNodes):
     data = []
     for node in validNodes:
@@ -199,80 +413,88 @@ def calc_diff_in_dist(validNodes):
         data.append((diff, node))
     return data
 
-
 '''
-Collect all nodes with less than maxItems
-'''
-def get_min_items(tree, maxItems):
-    validNodes = []
-    nodes_with_items(tree.root, validNodes, maxItems)
-    return len(validNodes)
+Compute the distributional bias of every node in a tree at once. The 
+distributions of books by women and books by men across the children of 
+every node are read from the children layout of the tree (TreeIndex) 
+using exact counts, and their base 2 entropies are computed with one 
+pass over all parent-child pairs using
+    H = log2(S) - sum(c * log2(c)) / S
+where c are the child counts and S is their sum.
 
-'''
-Helper function for get_min_items
-'''
-def nodes_with_items(node, nodes, max_items):
-    if node.item_count < max_items:
-        nodes.append(node)
-    for kid in node.children.values():
-        if kid is not None:
-            nodes_with_items(kid, nodes, max_items)
+Nodes are eligible if they have at least minItems books and minKids 
+children (the root is never eligible, as in nodes_with_constraints).
+Returns the positions of the eligible nodes in the tree's index, the 
+entropies of the distributions of books by women and by men (0 if there
+are no such books), and the [women flatter, men flatter] tallies over 
+the eligible nodes that have books by both women and men (as in 
+calc_dist_bias). The differences ent_m - ent_f can be ranked like the 
+output of calc_diff_in_dist.
+'''
+@inst.timed('item.dist_bias_arrays')
+def dist_bias_arrays(tree, minItems=100, minKids=2):
+    index = tree.get_index()
+    counts = np.array([node.gen_counts for node in index.nodes], dtype=np.float64)
+    item_counts = index.column('item_count')
+    kids = index.child_idx
+    parents = index.parent[kids]
+    n = len(index)
+    # per-parent sums and sum(c*log2(c)) over the children
+    kid_m, kid_f = counts[kids, 0], counts[kids, 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        clogc_m = np.where(kid_m > 0, kid_m * np.log2(kid_m), 0)
+        clogc_f = np.where(kid_f > 0, kid_f * np.log2(kid_f), 0)
+    sum_m = np.bincount(parents, weights=kid_m, minlength=n)
+    sum_f = np.bincount(parents, weights=kid_f, minlength=n)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ent_m = np.where(sum_m > 0, np.log2(sum_m) - np.bincount(parents, weights=clogc_m, 
+                                                                 minlength=n) / sum_m, 0)
+        ent_f = np.where(sum_f > 0, np.log2(sum_f) - np.bincount(parents, weights=clogc_f, 
+                                                                 minlength=n) / sum_f, 0)
+    # clip rounding error for single-child distributions
+    ent_m, ent_f = np.maximum(ent_m, 0), np.maximum(ent_f, 0)
+    eligible = (item_counts >= minItems) & (index.num_children() >= minKids)
+    eligible[0] = False
+    positions = np.flatnonzero(eligible)
+    ent_f, ent_m = ent_f[positions], ent_m[positions]
+    both = (sum_f[positions] > 0) & (sum_m[positions] > 0)
+    same = np.isclose(ent_f, ent_m, rtol=0, atol=1e-12) & both
+    flatter = [np.sum((ent_f < ent_m) & both & ~same) + 0.5*np.sum(same),
+               np.sum((ent_f > ent_m) & both & ~same) + 0.5*np.sum(same)]
+    return positions, ent_f, ent_m, [float(count) for count in flatter]
 
-'''
-Collect all nodes with less than maxKids
-'''
-def get_min_kids(tree, maxKids):
-    validNodes = []
-    nodes_with_kids(tree.root, validNodes, maxKids)
-    return len(validNodes)
 
 '''
-Helper function for get_min_kids
+Count all nodes with less than maxItems
 '''
-def nodes_with_kids(node, validNodes, max_kids):
-    num_kids = node.count_children()
-    if num_kids < max_kids:
-        validNodes.append(node)
-    for kid in node.children.values():
-        if kid is not None:
-            nodes_with_kids(kid, validNodes, max_kids)
+def get_min_items(tree, maxItems):
+    return nq.NodeTable(tree).count(nq.ITEMS < maxItems)
 
 '''
-Collect all nodes with books by men but not women. 
+Count all nodes with less than maxKids
 '''
-def nodes_without_women(tree):
-    validNodes = []
-    no_women(tree.root, validNodes)
-    return len(validNodes)
+def get_min_kids(tree, maxKids):
+    return nq.NodeTable(tree).count(nq.KIDS < maxKids)
 
 '''
-Helper function for nodes_without_women
+Count all nodes with books by men but not women. 
 '''
-def no_women(node, validNodes):
-    if node.item_count > 0 and node.prop_f == 0 and node.prop_m != 0:
-        validNodes.append(node)
-    for kid in node.children.values():
-        if kid is not None:
-            no_women(kid, validNodes)
+def nodes_without_women(tree):
+    return nq.NodeTable(tree).count((nq.FEMALE == 0) & (nq.MALE > 0))
 
 '''
-Collect all nodes with books by women but not men.
+Count all nodes with books by women but not men.
 '''
 def nodes_without_men(tree):
-    validNodes = []
-    no_men(tree.root, validNodes)
-    return len(validNodes) 
+    return nq.NodeTable(tree).count((nq.MALE == 0) & (nq.FEMALE > 0))
 
 '''
-Helper function for nodes_without_men.
+Count the nodes failing each of the constraints used in the distributional 
+bias analyses, with a single pass over the tree. Returns the number of nodes 
+with less than maxKids children, with less than maxItems books, without 
+books by women and without books by men.
 '''
-def no_men(node, validNodes):
-    if node.item_count > 0 and node.prop_m == 0 and node.prop_f != 0:
-        validNodes.append(node)
-    for kid in node.children.values():
-        if kid is not None:
-            no_men(kid, validNodes)
-
-
-
-
+def constraint_summary(tree, maxItems, maxKids):
+    table = nq.NodeTable(tree)
+    return table.count(nq.KIDS < maxKids, nq.ITEMS < maxItems,
+                       (nq.FEMALE == 0) & (nq.MALE > 0), (nq.MALE == 0) & (nq.FEMALE > 0))
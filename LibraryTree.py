@@ -1,7 +1,15 @@
 import os
 import re
+import sys
 import pickle
+import tracemalloc
+import numpy as np
 from csv import reader
+import Instrument as inst
+
+# author genders (as tagged in ItemBias.tag_books_fm) and their integer codes
+GENDERS = ['male', 'female', 'unknown', 'ambiguous']
+GENDER_CODES = {gen: code for code, gen in enumerate(GENDERS)}
 
 '''
 Generic class for a node in a library system
@@ -13,6 +21,9 @@ Generic class for a node in a library system
 - parent is the the direct parent of the current node
 '''
 class Node:
+    # key under which an item stores its deepest category in this system
+    cat_key = None
+
     def __init__(self, label, name, depth, parent=None):
         self.label = label
         self.name = name
@@ -22,9 +33,28 @@ class Node:
         self.items = [] 
         self.item_idx = []
         self.item_count = 0
+        # circulation aggregates for the items in the subtree rooted at this node
+        self.total_circ = 0
+        self.num_in_circ = 0
+        self.circ_year = 0
         self.west = None
-        self.prop_m = 0
-        self.prop_f = 0
+        # number of items in the subtree by authors of each gender (see GENDERS)
+        self.gen_counts = [0, 0, 0, 0]
+
+    '''
+    Proportion of items in the subtree by men and by women
+    '''
+    @property
+    def prop_m(self):
+        if self.item_count == 0:
+            return 0
+        return self.gen_counts[0] / self.item_count
+
+    @property
+    def prop_f(self):
+        if self.item_count == 0:
+            return 0
+        return self.gen_counts[1] / self.item_count
 
     '''
     Print the tree
@@ -69,12 +99,38 @@ class Node:
         self.items.append(item)
         self.item_count += 1
         self.item_idx.append(i)
+        self.add_circ(item)
+        code = GENDER_CODES.get(item.get('auth_gen'))
+        if code is not None:
+            self.gen_counts[code] += 1
+
+    '''
+    Update the circulation aggregates of a node with an item. Items are 
+    added to a category and all of its ancestors, so the aggregates of a 
+    node always cover its whole subtree. Items without circulation data
+    are counted as never circulated.
+    '''
+    def add_circ(self, item):
+        total_circ = item.get('total_circ', 0)
+        # total number of times books have been circulated
+        self.total_circ += total_circ
+        # number of books in circulation
+        if item.get('circ_status', 0) > 0:
+            self.num_in_circ += 1
+        # number of books that circulated in a year
+        if total_circ > 0:
+            self.circ_year += 1
 
     def empty_items(self):
         self.items = []
         self.item_idx = []
         self.item_count = 0
-        for child in self.children.values():
+        self.total_circ = 0
+        self.num_in_circ = 0
+        self.circ_year = 0
+        self.gen_counts = [0, 0, 0, 0]
+        # only the children that have been built (see LazyClasses)
+        for child in dict.values(self.children):
             if child is not None:
                 child.empty_items()
 
@@ -82,6 +138,8 @@ class Node:
 Node representing a category in the Library of Congress Classification System
 '''
 class LCCNode(Node):
+    cat_key = 'lcc_cat'
+
     def __init__(self, label, name, depth, parent=None):
         super().__init__(label, name, depth, parent)
 
@@ -123,19 +181,90 @@ class NumNode(LCCNode):
         return minVal, maxVal
     
 
+'''
+Dict of the main classes of a lazily built tree, keyed by class label. The
+labels of all classes are known up front but a class is only built (by 
+calling load with its label) the first time it is looked up. Iterating 
+over the keys does not build any class, but iterating over the values or 
+items builds them all (in the order of keys). Pickling keeps the classes
+that have been built and the loader of the others.
+'''
+class LazyClasses(dict):
+    def __init__(self, load, keys):
+        super().__init__()
+        self.load = load
+        self.order = list(keys)
+        self.known = set(self.order)
+
+    def ensure(self, key):
+        if key in self.known and not dict.__contains__(self, key):
+            self.load(key)
+
+    def __getitem__(self, key):
+        self.ensure(key)
+        return dict.__getitem__(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.known:
+            self.known.add(key)
+            self.order.append(key)
+        dict.__setitem__(self, key, value)
+
+    def get(self, key, default=None):
+        self.ensure(key)
+        return dict.get(self, key, default)
+
+    def __contains__(self, key):
+        return key in self.known
+
+    def __iter__(self):
+        return iter(list(self.order))
+
+    def __len__(self):
+        return len(self.order)
+
+    def keys(self):
+        return list(self.order)
+
+    def values(self):
+        return [self[key] for key in list(self.order)]
+
+    def items(self):
+        return [(key, self[key]) for key in list(self.order)]
+
+    # The classes that have been built so far
+    def loaded(self):
+        return [key for key in self.order if dict.__contains__(self, key)]
+
+    def __reduce__(self):
+        built = [(key, dict.__getitem__(self, key)) for key in self.loaded()]
+        return (LazyClasses, (self.load, self.order), None, None, iter(built))
+
 '''
 Library of Congress Classification tree structure representation
 - folder is the path for the folder in which the cvs records used to create
   the lcc tree are stored
+- if lazy is True, each main class (its subtree, hash table entries and 
+  subclass labels) is only built the first time it is accessed, through 
+  root.children, hash_table, labels or when books are added to it. Walking 
+  the whole tree (i.e. get_index) builds every class.
 ''' 
 class LCCTree:
-    def __init__(self, folder):
+    # key under which an item stores its class number
+    num_key = 'lcc'
+
+    def __init__(self, folder, lazy=False):
         self.root = LCCNode('LCC', 'Library of Congress Classification', 0)
         self.labels = {}
         # used to quickly find the category associated with a classification number  
         self.hash_table = {} 
         self.item_count = 0
         self.node_count = 0
+        # flat layout of the tree, built on first use
+        self.index = None
+        self.lazy = lazy
+        # csv file of each main class that has not been built yet (lazy trees)
+        self.class_files = {}
         self.build_tree(folder)
 
     '''
@@ -144,15 +273,31 @@ class LCCTree:
     @staticmethod
     def read_csv(folder):
         data = []
+        with inst.timer('lcc.read_csv') as t:
+            for cat, name, f in LCCTree.list_csv(folder):
+                data.append((cat, name, LCCTree.read_class_csv(f)))
+            # rows read
+            t.items = sum(len(rows) for _, _, rows in data)
+        return data
+
+    '''
+    List the csv files in a folder as (main class, name, path) tuples
+    '''
+    @staticmethod
+    def list_csv(folder):
+        files_list = []
         for subdir, _, files in os.walk(folder):
             for file in files:
-                f = subdir + os.sep + file
-                cat = file[0]
-                name = file[4:-4]
-                with open(f, 'r', encoding="utf8") as read_obj:
-                    csv_reader = reader(read_obj)
-                    data.append((cat, name, list(csv_reader)))
-        return data
+                files_list.append((file[0], file[4:-4], subdir + os.sep + file))
+        return files_list
+
+    '''
+    Read the rows of the csv file of one main class
+    '''
+    @staticmethod
+    def read_class_csv(f):
+        with open(f, 'r', encoding="utf8") as read_obj:
+            return list(reader(read_obj))
 
     '''
     Find the name and label of a LCC category stored in a csv file
@@ -236,21 +381,52 @@ class LCCTree:
     of the system.
     '''       
     def build_tree(self, folder):
-        data = self.read_csv(folder)
-        for csv in data:
-            subtree = self.csv_to_tree(csv)
-            label = subtree.label
-            self.root.children[label] = subtree
-            self.labels[subtree.label] = [kid.label[1:] for kid in subtree.children.values()
-                                          if kid.label is not None and len(kid.label) > 1 
-                                          and kid.label.isalpha()]
-            if label != 'A':
-                self.labels[subtree.label] += [None]
-        self.node_count = self.root.count_descendants()
-
-        self.build_hash() #used to access subcategories more efficiently
-        self.labels['K'] = [label[1:] for label in self.hash_table['K'].keys() 
-                    if label.isalpha() and  len(label) > 1 and label != 'node'] + [None]
+        with inst.timer('lcc.build_tree') as t:
+            if self.lazy:
+                files = self.list_csv(folder)
+                self.class_files = {cat: (name, f) for cat, name, f in files}
+                cats = [cat for cat, _, _ in files]
+                self.root.children = LazyClasses(self.load_class, cats)
+                self.labels = LazyClasses(self.load_class, cats)
+                self.hash_table = LazyClasses(self.load_class, cats)
+            else:
+                for csv in self.read_csv(folder):
+                    self.add_class(csv)
+            t.items = self.node_count
+
+    '''
+    Build a main class from its csv data: its subtree, subclass labels and
+    hash table entries
+    '''
+    def add_class(self, csv):
+        subtree = self.csv_to_tree(csv)
+        label = subtree.label
+        self.root.children[label] = subtree
+        self.labels[subtree.label] = [kid.label[1:] for kid in subtree.children.values()
+                                      if kid.label is not None and len(kid.label) > 1 
+                                      and kid.label.isalpha()]
+        if label != 'A':
+            self.labels[subtree.label] += [None]
+        self.node_count += subtree.count_nodes()
+
+        #used to access subcategories more efficiently
+        with inst.timer('lcc.build_hash', subtree.count_nodes()):
+            self.hash_class(subtree)
+        if label == 'K':
+            self.labels['K'] = [label[1:] for label in self.hash_table['K'].keys() 
+                        if label.isalpha() and  len(label) > 1 and label != 'node'] + [None]
+
+    '''
+    Build a main class of a lazy tree the first time it is accessed. The
+    structure of the tree changes so its index is rebuilt on next use.
+    '''
+    def load_class(self, cat):
+        if cat not in self.class_files:
+            return
+        name, f = self.class_files.pop(cat)
+        with inst.timer('lcc.load_class'):
+            self.add_class((cat, name, self.read_class_csv(f)))
+        self.index = None
 
     '''
     Build hash table entries for further divisions (numeric subcategories) of the LCC
@@ -340,12 +516,16 @@ class LCCTree:
     its categories
     '''
     def build_hash(self):
-        for tree in self.root.children.values():
-            # Class K must be treated as a special case
-            if tree.label == 'K':
-                self.k_hash(tree)
-            else:
-                self.alpha_hash(tree)
+        with inst.timer('lcc.build_hash', self.node_count):
+            for tree in self.root.children.values():
+                self.hash_class(tree)
+
+    def hash_class(self, tree):
+        # Class K must be treated as a special case
+        if tree.label == 'K':
+            self.k_hash(tree)
+        else:
+            self.alpha_hash(tree)
 
     '''
     Get the components of a LCC number. They are:
@@ -372,6 +552,23 @@ class LCCTree:
             subCls = None
         return (mainCls, subCls, division)
 
+    '''
+    Get category in LCC from its label, i.e. 'E' (a main class), 'BL' (a 
+    subclass), 'BL685' or 'BL689-980' (a further division of a subclass)
+    '''
+    def get_node(self, label):
+        digIdx = getDigitIdx(label)
+        letters = label if digIdx == -1 else label[:digIdx]
+        mainCls = label[0]
+        if len(letters) == 1:
+            nodes = self.hash_table[mainCls]
+        else:
+            nodes = self.hash_table[mainCls][letters]
+        if digIdx == -1:
+            return nodes['node']
+        nums = label[digIdx:].split('-')
+        return nodes[(float(nums[0]), float(nums[-1]))]
+
     '''
     Check if a number is a valid instance of an LCC number
     '''
@@ -387,48 +584,112 @@ class LCCTree:
     Assume that item formats have already been checked as valid LCC 
     '''
     def add_books(self, bookList):
+        with inst.timer('lcc.add_books', len(bookList)):
+            self.add_book_list(bookList)
+
+    '''
+    Add books to the tree (add_books without the timer)
+    '''
+    def add_book_list(self, bookList):
         i = -1
+        # counts kept for Instrument: books whose subclass is (hits) or is not
+        # (misses) in the hash table, books not resolved to a category and
+        # numeric ranges scanned to find categories
+        hits, misses, unresolved, scanned = 0, 0, 0, 0
         for book in bookList:
-            # get lcc category labels 
-            mainCls, subCls, div = self.getComponents(book['lcc'])
-            if subCls not in self.labels[mainCls]:
+            node, num_scanned = self.find_category(book['lcc'])
+            if num_scanned is None:
+                misses += 1
                 continue
-            elif subCls is None:
-                subCls = mainCls
-            else:
-                subCls = mainCls + subCls
-            # find subclass 
-            if mainCls == 'E' or mainCls == 'F':
-                nodes = self.hash_table[mainCls]
-                node = None
-            elif mainCls == 'K': 
-                nodes = self.hash_table[mainCls][subCls]
-                if 'node' in nodes.keys():
-                    node = nodes['node']
-                else:
-                    node = None
-            else:
-                nodes = self.hash_table[mainCls][subCls]
-                node = nodes['node']
-            if div is not None:
-                # find deepest category associated with a book
-                valRange = 9999
-                for label in nodes.keys():
-                    if label != 'node':
-                        diff = label[1] - label[0]
-                        # the smaller the numerical range, the greater the depth
-                        if div >= label[0] and div <= label[1] and diff <= valRange:
-                            node = nodes[label]
-                            valRange = diff
+            hits += 1
+            scanned += num_scanned
             # add book to its categories
             if node is not None: 
                 self.item_count += 1
                 book['lcc_cat'] = node 
                 i += 1
+            else:
+                unresolved += 1
             while node is not None:
                 node.add_item(book, i)
                 node = node.parent
             # keep track of book count 
+        if inst.ENABLED:
+            inst.count('lcc.hash_hits', hits)
+            inst.count('lcc.hash_misses', misses)
+            inst.count('lcc.unresolved', unresolved)
+            inst.count('lcc.range_candidates', scanned)
+
+    '''
+    Find the deepest category of an LCC number. Returns the category (None
+    if the number is not resolved to one) and the number of numeric ranges
+    scanned to find it (None if the main class or subclass is not in the
+    hash table).
+    '''
+    def find_category(self, lcc):
+        # get lcc category labels 
+        mainCls, subCls, div = self.getComponents(lcc)
+        subClasses = self.labels.get(mainCls)
+        if subClasses is None or subCls not in subClasses:
+            return None, None
+        nodes, node = self.subclass_entry(mainCls, subCls)
+        if div is None:
+            return node, 0
+        # find deepest category associated with a book
+        valRange = 9999
+        for label in nodes.keys():
+            if label != 'node':
+                diff = label[1] - label[0]
+                # the smaller the numerical range, the greater the depth
+                if div >= label[0] and div <= label[1] and diff <= valRange:
+                    node = nodes[label]
+                    valRange = diff
+        return node, len(nodes)
+
+    '''
+    Get the hash table entry of a subclass (the numeric ranges of its 
+    categories) and the category that numbers in the subclass are placed 
+    in if they are not in any of those ranges (None if there is none)
+    '''
+    def subclass_entry(self, mainCls, subCls):
+        if subCls is None:
+            subCls = mainCls
+        else:
+            subCls = mainCls + subCls
+        # find subclass 
+        if mainCls == 'E' or mainCls == 'F':
+            nodes = self.hash_table[mainCls]
+            node = None
+        elif mainCls == 'K': 
+            nodes = self.hash_table[mainCls][subCls]
+            if 'node' in nodes.keys():
+                node = nodes['node']
+            else:
+                node = None
+        else:
+            nodes = self.hash_table[mainCls][subCls]
+            node = nodes['node']
+        return nodes, node
+
+    '''
+    Classify a sequence of LCC numbers without adding them to the tree.
+    Returns the position of the deepest category of each number in the 
+    tree's index, or -1 if the number is not resolved to a category. 
+    Numbers are often repeated, so each distinct number is only looked 
+    up once.
+    '''
+    def classify(self, nums):
+        index = self.get_index()
+        found = {}
+        positions = np.empty(len(nums), dtype=np.int64)
+        for j, lcc in enumerate(nums):
+            pos = found.get(lcc)
+            if pos is None:
+                node, _ = self.find_category(lcc)
+                pos = -1 if node is None else index.position(node)
+                found[lcc] = pos
+            positions[j] = pos
+        return positions
 
 
     '''
@@ -439,6 +700,22 @@ class LCCTree:
         self.item_count = 0
         root.empty_items()
 
+    '''
+    Get a flat (preorder) layout of the tree. The structure of the tree 
+    does not change once built so the layout is only computed once.
+    '''
+    def get_index(self):
+        if self.index is None:
+            self.index = TreeIndex(self.root)
+        return self.index
+
+    '''
+    Report the memory used by the tree, per component and per main class
+    (see tree_memory)
+    '''
+    def memory_report(self):
+        return tree_memory(self)
+
     '''
     Find the deepest node (category) that is shared by two nodes in the LCC
     '''
@@ -465,6 +742,8 @@ class LCCTree:
 Node representing a category in the Dewey Decimal Classification System
 '''   
 class DeweyNode(Node):
+    cat_key = 'ddc_cat'
+
     def __init__(self, label, name, depth, parent=None):
         super().__init__(label, name, depth, parent)
         self.parse = self.label.replace('.', '')
@@ -486,10 +765,19 @@ Dewey Decimal System Data Structure
   the DDC tree are stored
 '''
 class DDCTree:
-    def __init__(self, folder):
+    # key under which an item stores its class number
+    num_key = 'ddc'
+
+    def __init__(self, folder, lazy=False):
         self.root = DeweyNode('DDC', 'Dewey Decimal System', 0)
         self.item_count = 0
         self.node_count = 0
+        # flat layout of the tree, built on first use
+        self.index = None
+        self.lazy = lazy
+        # summary rows and fine-grained categories of each main class that 
+        # has not been built yet (lazy trees)
+        self.class_data = {}
         self.build_tree(folder)
     
     '''
@@ -497,10 +785,22 @@ class DDCTree:
     for the first 3 levels of categories in the DDC
     '''
     def txt_to_tree(self, fp):
+        self.add_summary_rows(self.read_txt(fp))
+
+    '''
+    Read the rows of the text file of DDC categories
+    '''
+    @staticmethod
+    def read_txt(fp):
         with open(fp, 'r') as f:
             data = f.readlines()
-        for row in data[1:]:
-            row_data = row.replace('\n', '').split('\t')
+        return [row.replace('\n', '').split('\t') for row in data[1:]]
+
+    '''
+    Add the categories in rows of the text file of DDC categories
+    '''
+    def add_summary_rows(self, rows):
+        for row_data in rows:
             depth = int(row_data[2])
             label = row_data[0][:depth]
             name = row_data[1]
@@ -535,10 +835,23 @@ class DDCTree:
     (after the decimal place)
     ''' 
     def load_fg_cats(self, fp):
+        self.add_fg_cats(self.read_fg_cats(fp))
+
+    '''
+    Read the (number, name) pairs of the DDC categories at depths of 4 or 
+    greater, sorted by number
+    '''
+    @staticmethod
+    def read_fg_cats(fp):
         with open (fp, 'rb') as f:
             fg_cats =  pickle.load(f)
         fg_cats.sort(key=lambda x : float(x[0]))
-        fg_cats = [tup for tup in fg_cats if len(tup[0]) > 3]
+        return [tup for tup in fg_cats if len(tup[0]) > 3]
+
+    '''
+    Add (number, name) pairs of DDC categories at depths of 4 or greater
+    '''
+    def add_fg_cats(self, fg_cats):
         for ddc, name in fg_cats:
             parent = self.get_node(ddc[:-1])
             node = DeweyNode(ddc, name, parent.depth+1, parent)
@@ -546,30 +859,97 @@ class DDCTree:
             self.node_count += 1
     
     '''
-    Build a representation of the DDC
+    Build a representation of the DDC. The fine-grained categories are read
+    from ddc_fg_orig.pk, or from ddc_fg.pk (as written by the Dewey scraper)
+    if there is no ddc_fg_orig.pk in the folder. If the tree is lazy, the
+    categories of each main class (hundreds) are only added the first time 
+    the class is accessed through root.children (i.e. by get_node or when 
+    books are added to it).
     '''
     def build_tree(self, folder):
-        self.txt_to_tree(folder + '/ddc22-summaries-eng.txt')
-        self.load_fg_cats(folder + '/ddc_fg_orig.pk')
+        with inst.timer('ddc.build_tree') as t:
+            rows = self.read_txt(folder + '/ddc22-summaries-eng.txt')
+            fg_fp = folder + '/ddc_fg_orig.pk'
+            if not os.path.exists(fg_fp):
+                fg_fp = folder + '/ddc_fg.pk'
+            fg_cats = self.read_fg_cats(fg_fp)
+            if self.lazy:
+                cats = [row[0][0] for row in rows if int(row[2]) == 1]
+                self.class_data = {cat: ([], []) for cat in cats}
+                for row in rows:
+                    self.class_data[row[0][0]][0].append(row)
+                for tup in fg_cats:
+                    self.class_data[tup[0][0]][1].append(tup)
+                self.root.children = LazyClasses(self.load_class, cats)
+            else:
+                self.add_summary_rows(rows)
+                self.add_fg_cats(fg_cats)
+            t.items = self.node_count
+
+    '''
+    Build a main class of a lazy tree the first time it is accessed. The
+    structure of the tree changes so its index is rebuilt on next use.
+    '''
+    def load_class(self, cat):
+        if cat not in self.class_data:
+            return
+        rows, fg_cats = self.class_data.pop(cat)
+        with inst.timer('ddc.load_class'):
+            self.add_summary_rows(rows)
+            self.add_fg_cats(fg_cats)
+        self.index = None
 
     '''
     Add books from a list of books to an instance of a DDC Tree 
     Assume that item formats have already been checked as valid DDC 
     '''
     def add_books(self, bookList):
+        with inst.timer('ddc.add_books', len(bookList)):
+            self.add_book_list(bookList)
+
+    '''
+    Add books to the tree (add_books without the timer)
+    '''
+    def add_book_list(self, bookList):
         for (i, book) in enumerate(bookList):
-            ddc = book['ddc']
-            digits = ddc.replace('.', '')
-            node = self.root
-            j = 0
-            node.add_item(book, i)
-            while node.children != {} and j < len(digits) and digits[j] in node.children.keys():
-                child = node.children[digits[j]]
-                child.add_item(book, i)
-                node = child
-                j += 1
-            self.item_count += 1
+            node = self.find_category(book['ddc'])
             book['ddc_cat'] = node
+            while node is not None:
+                node.add_item(book, i)
+                node = node.parent
+            self.item_count += 1
+
+    '''
+    Find the deepest category of a DDC number (the root if the number has 
+    no category in the tree)
+    '''
+    def find_category(self, ddc):
+        digits = ddc.replace('.', '')
+        node = self.root
+        j = 0
+        while len(node.children) > 0 and j < len(digits) and digits[j] in node.children.keys():
+            node = node.children[digits[j]]
+            j += 1
+        return node
+
+    '''
+    Classify a sequence of DDC numbers without adding them to the tree.
+    Returns the position of the deepest category of each number in the 
+    tree's index (see find_category), or -1 if no category matches its 
+    first digit. Each distinct number is only looked up once.
+    '''
+    def classify(self, nums):
+        index = self.get_index()
+        found = {}
+        positions = np.empty(len(nums), dtype=np.int64)
+        for j, ddc in enumerate(nums):
+            pos = found.get(ddc)
+            if pos is None:
+                node = self.find_category(ddc)
+                pos = -1 if node is self.root else index.position(node)
+                found[ddc] = pos
+            positions[j] = pos
+        return positions
 
     '''
     Find the deepest node (category) that is shared by two nodes in the LCC
@@ -590,6 +970,222 @@ class DDCTree:
         root = self.root
         root.empty_items()
 
+    '''
+    Get a flat (preorder) layout of the tree. The structure of the tree 
+    does not change once built so the layout is only computed once.
+    '''
+    def get_index(self):
+        if self.index is None:
+            self.index = TreeIndex(self.root)
+        return self.index
+
+    '''
+    Report the memory used by the tree, per component and per main class
+    (see tree_memory)
+    '''
+    def memory_report(self):
+        return tree_memory(self)
+
+'''
+Flat layout of a tree (or subtree) of nodes. Nodes are stored in preorder
+so that the subtree of the node at position i is the range i to end[i]. 
+- nodes is the list of nodes in preorder
+- parent is the position of each node's parent (-1 for the root of the layout)
+- depth is the depth of each node in its classification system
+- end is the position just past the last descendant of each node
+- child_ptr and child_idx store the children of each node in compressed 
+  sparse row format: the children of node i are child_idx[child_ptr[i]:child_ptr[i+1]]
+'''
+class TreeIndex:
+    def __init__(self, root):
+        nodes, parent = [], []
+        stack = [(root, -1)]
+        while stack:
+            node, par = stack.pop()
+            parent.append(par)
+            i = len(nodes)
+            nodes.append(node)
+            kids = [kid for kid in node.children.values() if kid is not None]
+            # push in reverse so children are visited in their stored order
+            for kid in reversed(kids):
+                stack.append((kid, i))
+        n = len(nodes)
+        self.nodes = nodes
+        self.parent = np.array(parent, dtype=np.int64)
+        self.depth = np.fromiter((node.depth for node in nodes), dtype=np.int64, count=n)
+        # subtree sizes, accumulated from the deepest nodes up 
+        size = [1] * n
+        for i in range(n-1, 0, -1):
+            size[parent[i]] += size[i]
+        self.end = np.arange(n, dtype=np.int64) + np.array(size, dtype=np.int64)
+        # children grouped by parent, stable so preorder is kept within a parent
+        counts = np.bincount(self.parent[1:], minlength=n)
+        self.child_ptr = np.concatenate(([0], np.cumsum(counts)))
+        self.child_idx = np.argsort(self.parent[1:], kind='stable') + 1
+        self.positions = {id(node): i for i, node in enumerate(nodes)}
+
+    def __len__(self):
+        return len(self.nodes)
+
+    '''
+    Find the position of a node in the layout
+    '''
+    def position(self, node):
+        return self.positions[id(node)]
+
+    '''
+    Count the direct descendants of every node
+    '''
+    def num_children(self):
+        return np.diff(self.child_ptr)
+
+    '''
+    Count all the descendants (direct or indirect) of every node
+    '''
+    def num_descendants(self):
+        return self.end - np.arange(len(self.nodes)) - 1
+
+    '''
+    Sum values given per node (i.e. counts of the items classified directly 
+    at each node) over the subtree of every node. Since subtrees are 
+    contiguous in preorder this is a difference of cumulative sums.
+    '''
+    def rollup(self, values):
+        values = np.asarray(values)
+        cumsum = np.concatenate((np.zeros((1,) + values.shape[1:], dtype=values.dtype), 
+                                 np.cumsum(values, axis=0)))
+        return cumsum[self.end] - cumsum[:-1]
+
+    '''
+    Collect an attribute of every node into an array
+    '''
+    def column(self, attr, dtype=np.int64):
+        return np.fromiter((getattr(node, attr) for node in self.nodes), dtype=dtype,
+                           count=len(self.nodes))
+
+
+'''
+MEMORY ACCOUNTING
+
+Estimate the memory used by the parts of a tree by walking its structures
+and adding up sys.getsizeof of every object reached. Objects shared by
+several structures (i.e. strings used as both labels and hash keys, or
+books added to two trees) are counted once, in the first component that 
+reaches them. Components are:
+- nodes: node objects with their attributes and children dicts
+- item_lists: the items and item_idx lists of every node
+- books: the book dicts stored in the tree (and their fields)
+- hash_table: the nested hash table of an LCC tree
+- labels: the subclass labels of an LCC tree
+- index: the TreeIndex of the tree, if it has been built
+'''
+
+'''
+Size of an object and the containers and values it holds. Objects in seen
+are skipped (and new objects are added to it) and nodes are not followed.
+'''
+def deep_size(obj, seen):
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, Node):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            # only what is stored (classes of lazy trees that have not been
+            # built are not counted)
+            stack.extend(dict.keys(obj))
+            stack.extend(dict.values(obj))
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+    return size
+
+'''
+Size of the node objects, item lists and books in the subtree of a node
+'''
+def subtree_memory(root, seen):
+    sizes = {'nodes': 0, 'item_lists': 0, 'books': 0}
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        attrs = node.__dict__
+        sizes['nodes'] += sys.getsizeof(node) + sys.getsizeof(attrs)
+        for attr, val in attrs.items():
+            if attr not in ('items', 'item_idx', 'parent'):
+                sizes['nodes'] += deep_size(val, seen)
+        sizes['item_lists'] += sys.getsizeof(node.items) + deep_size(node.item_idx, seen)
+        seen.add(id(node.items))
+        for item in node.items:
+            sizes['books'] += deep_size(item, seen)
+        stack.extend(kid for kid in node.children.values() if kid is not None)
+    return sizes
+
+'''
+Memory report for an LCCTree or DDCTree: the number of bytes used by each
+component (see above), by each main class (nodes, item lists, books and
+hash table entries in its subtree) and in total.
+'''
+def tree_memory(tree):
+    seen = set()
+    components = {'nodes': sys.getsizeof(tree.root) + sys.getsizeof(tree.root.__dict__),
+                  'item_lists': 0, 'books': 0, 'hash_table': 0, 'labels': 0, 'index': 0}
+    seen.add(id(tree.root.items))
+    seen.add(id(tree.root.item_idx))
+    main_classes = {}
+    hash_table = getattr(tree, 'hash_table', {})
+    for label, child in list(dict.items(tree.root.children)):
+        if child is None:
+            continue
+        sizes = subtree_memory(child, seen)
+        sizes['hash_table'] = deep_size(dict.get(hash_table, label, {}), seen)
+        main_classes[label] = sizes
+        for comp, size in sizes.items():
+            components[comp] += size
+    # remaining root attributes and any books not stored under a main class
+    for attr, val in tree.root.__dict__.items():
+        if attr not in ('items', 'item_idx', 'parent'):
+            components['nodes'] += deep_size(val, seen)
+    components['item_lists'] += sys.getsizeof(tree.root.items) + deep_size(tree.root.item_idx, seen)
+    for item in tree.root.items:
+        components['books'] += deep_size(item, seen)
+    if hasattr(tree, 'hash_table'):
+        components['hash_table'] += deep_size(hash_table, seen)
+        components['labels'] = deep_size(tree.labels, seen)
+    if tree.index is not None:
+        index = tree.index
+        components['index'] = (deep_size(index.nodes, seen) + deep_size(index.positions, seen) +
+                               sum(arr.nbytes for arr in [index.parent, index.depth, index.end,
+                                                          index.child_ptr, index.child_idx]))
+    return {'components': components, 'main_classes': main_classes,
+            'total': sum(components.values())}
+
+'''
+Trace the memory allocated while calling func(*args, **kwargs), i.e. 
+trace_memory(LCCTree, folder) or trace_memory(tree.add_books, books), with
+a tracemalloc snapshot diff. Returns the result of the call and a report of
+the net and peak bytes allocated and the limit source lines that allocated
+the most memory, as (file:line, bytes, number of blocks) tuples.
+'''
+def trace_memory(func, *args, limit=10, **kwargs):
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    before = tracemalloc.take_snapshot()
+    start, _ = tracemalloc.get_traced_memory()
+    result = func(*args, **kwargs)
+    end, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    if not tracing:
+        tracemalloc.stop()
+    diff = after.compare_to(before, 'lineno')
+    top = [(f'{stat.traceback[0].filename}:{stat.traceback[0].lineno}', stat.size_diff,
+            stat.count_diff) for stat in diff[:limit]]
+    return result, {'allocated': end - start, 'peak': peak - start, 'top': top}
+
+
 '''
 General functions to help with Library Classification Systems
 
@@ -0,0 +1,175 @@
+import os
+import sys
+import mmap
+import time
+import pickle
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from pymarc import Record
+
+'''
+Parallel extraction of the OhioLINK MARC records. This does what getMarcData
+in Data/OhioLINK Data Extraction.ipynb does (the LCC and DDC numbers, main
+author, title, publication year and OCLC number of every record) but splits
+each MARC file into byte ranges of whole records and parses the ranges in
+a process pool, so extraction scales with the number of cores.
+
+MARC files are ISO 2709: every record starts with a 24 character leader
+whose first 5 characters are the length of the record in bytes, and ends
+with a record terminator. Files are split by reading those lengths only,
+without parsing the records. Each range is parsed with pymarc into a
+columnar batch (a dict of columns with one entry per record), i.e.
+    for batch in iter_batches(['OhioLINK_1.marc', 'OhioLINK_2.marc']):
+        ...
+    books = read_marc(['OhioLINK_1.marc', 'OhioLINK_2.marc'])
+'''
+
+RECORD_TERMINATOR = b'\x1d'
+# columns of a batch, as the keys of the book dicts made by getMarcData
+COLUMNS = ['title', 'auth', 'lcc', 'ddc', 'pub', 'oclc']
+
+'''
+Find the offset of the record after the one starting at off in a buffer of
+size bytes, using the length in the record's leader. If the leader does 
+not hold a valid length, the next record is found from the record 
+terminator.
+'''
+def next_record(buf, off, size):
+    length = buf[off:off+5]
+    if length.isdigit() and int(length) > 0:
+        return min(off + int(length), size)
+    end = buf.find(RECORD_TERMINATOR, off)
+    return size if end == -1 else end + 1
+
+'''
+Find the byte offset of every record in a MARC file, with the size of the
+file appended
+'''
+def record_offsets(fp):
+    size = os.path.getsize(fp)
+    offsets = []
+    if size > 0:
+        with open(fp, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            off = 0
+            while off < size:
+                offsets.append(off)
+                off = next_record(mm, off, size)
+    offsets.append(size)
+    return np.array(offsets, dtype=np.int64)
+
+'''
+Split a MARC file into byte ranges (start, end) of whole records, each
+about chunk_bytes long
+'''
+def split_file(fp, chunk_bytes=2**26):
+    offsets = record_offsets(fp)
+    # record boundaries closest to every multiple of chunk_bytes
+    cuts = np.searchsorted(offsets, np.arange(0, offsets[-1], chunk_bytes))
+    cuts = np.unique(np.append(cuts, len(offsets) - 1))
+    bounds = offsets[cuts].tolist()
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+'''
+Get the first subfield a of the fields with a tag, or of the fields with
+a fallback tag if there are none (i.e. locally assigned numbers in 090)
+'''
+def get_subfields(record, tag, fallback=None):
+    values = [subfield for field in record.get_fields(tag) for subfield in field.get_subfields('a')]
+    if values == [] and fallback is not None:
+        values = [subfield for field in record.get_fields(fallback)
+                  for subfield in field.get_subfields('a')]
+    return values
+
+'''
+Parse the records in a byte range of a MARC file into a columnar batch.
+Records are parsed one at a time, so a record that pymarc cannot parse
+(or that has no OCLC number in field 001) is skipped, and counted in 
+'skipped', without losing the records after it.
+'''
+def parse_range(fp, start, end):
+    with open(fp, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    batch = {col: [] for col in COLUMNS}
+    skipped = 0
+    off = 0
+    while off < len(data):
+        nxt = next_record(data, off, len(data))
+        try:
+            record = Record(data[off:nxt], to_unicode=True, force_utf8=True, 
+                            utf8_handling='ignore')
+            oclc = int(record['001'].value()[3:])
+        except Exception:
+            record = None
+        off = nxt
+        if record is None:
+            skipped += 1
+            continue
+        # Library of Congress Call Number
+        lcc = get_subfields(record, '050', '090')
+        # Dewey Decimal Classification Number
+        ddc = get_subfields(record, '082', '092')
+        batch['title'].append(record.title)
+        batch['auth'].append(get_subfields(record, '100'))
+        batch['lcc'].append(lcc if lcc != [] else None)
+        batch['ddc'].append(ddc if ddc != [] else None)
+        batch['pub'].append(record.pubyear)
+        batch['oclc'].append(oclc)
+    batch['oclc'] = np.array(batch['oclc'], dtype=np.int64)
+    batch['skipped'] = skipped
+    return batch
+
+def parse_job(job):
+    return parse_range(*job)
+
+'''
+Parse MARC files in a process pool, yielding one columnar batch per byte
+range in the order of the records in the files
+'''
+def iter_batches(fps, workers=None, chunk_bytes=2**26):
+    jobs = [(fp, start, end) for fp in fps for start, end in split_file(fp, chunk_bytes)]
+    if workers == 1:
+        for job in jobs:
+            yield parse_job(job)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        yield from pool.map(parse_job, jobs)
+
+'''
+Convert a batch into the book dicts made by getMarcData
+'''
+def to_books(batch):
+    columns = [batch[col] if col != 'oclc' else batch[col].tolist() for col in COLUMNS]
+    return [dict(zip(COLUMNS, values)) for values in zip(*columns)]
+
+'''
+Read the records of MARC files into a list of book dicts (as stored in
+marcData.pk before circulation data is added)
+'''
+def read_marc(fps, workers=None, chunk_bytes=2**26):
+    books = []
+    for batch in iter_batches(fps, workers, chunk_bytes):
+        books.extend(to_books(batch))
+    return books
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Extract bibliographic data from MARC files')
+    parser.add_argument('marc', nargs='+', help='MARC files')
+    parser.add_argument('--out', required=True, help='pickle file to write the book dicts to')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--chunk-mb', type=int, default=64, help='size of the byte ranges parsed per job')
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    books, skipped = [], 0
+    for batch in iter_batches(args.marc, args.workers, args.chunk_mb * 2**20):
+        books.extend(to_books(batch))
+        skipped += batch['skipped']
+    with open(args.out, 'wb') as f:
+        pickle.dump(books, f)
+    print(f'{len(books)} records read ({skipped} skipped) in {time.perf_counter() - start:.1f}s')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
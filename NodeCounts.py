@@ -0,0 +1,207 @@
+import numpy as np
+import polars as pl
+import LibraryTree as lt
+import Instrument as inst
+
+'''
+Counts-only ingestion of item collections too large to hold in memory.
+Most of the analyses (items per category, gender proportions, circulation
+aggregates and depth histograms) only need per-node counts and sums, not
+the items themselves. Items are read from disk in chunks of columns, each
+chunk is classified against an LCCTree or DDCTree (see classify) and only
+per-node aggregate arrays are kept, so memory does not grow with the size
+of the collection, i.e.
+    counts = NodeCounts(lcc)
+    counts.add_file('holdings.parquet')
+    counts.apply()
+    ib.depth_hists(lcc)
+
+Items are given as columns: the class number ('lcc' or 'ddc'), the author
+gender as a code (see LibraryTree.GENDERS, -1 if untagged) in 'gender' or
+as a string in 'auth_gen', and optionally 'total_circ' and 'circ_status'.
+'''
+
+# statistics kept per node and gender (as in ItemBias.grouped_circ_stats):
+# the number of items, the number in circulation, the number taken out in
+# the year and the annual circulation
+STATS = ['items', 'in_circ', 'circ_year', 'total_circ']
+# column of the counts of items without a gender
+NO_GENDER = len(lt.GENDERS)
+
+'''
+Gender codes of a chunk of items (-1 for untagged items)
+'''
+def gender_column(columns, n):
+    if 'gender' in columns:
+        return np.asarray(columns['gender'], dtype=np.int64)
+    if 'auth_gen' in columns:
+        return np.fromiter((lt.GENDER_CODES.get(gen, -1) for gen in columns['auth_gen']),
+                           dtype=np.int64, count=n)
+    return np.full(n, -1, dtype=np.int64)
+
+'''
+Convert a list of book dicts (as stored in marcData.pk or made by
+Synthetic.make_catalogue) into columns
+'''
+def book_columns(books, key):
+    n = len(books)
+    return {key: [book[key] for book in books],
+            'gender': np.fromiter((lt.GENDER_CODES.get(book.get('auth_gen'), -1) for book in books),
+                                  dtype=np.int64, count=n),
+            'total_circ': np.fromiter((book.get('total_circ', 0) for book in books),
+                                      dtype=np.int64, count=n),
+            'circ_status': np.fromiter((book.get('circ_status', 0) for book in books),
+                                       dtype=np.int64, count=n)}
+
+'''
+Read the item columns of a Parquet or CSV file in chunks of at most chunk
+rows. The file is streamed, so only one chunk is in memory at a time. Rows
+without a class number are skipped.
+'''
+def iter_chunks(fp, key, chunk=1000000):
+    if fp.endswith('.csv'):
+        # class numbers are read as strings (DDC numbers would be read as floats)
+        scan = pl.scan_csv(fp, schema_overrides={key: pl.String})
+    else:
+        scan = pl.scan_parquet(fp)
+    names = [name for name in [key, 'gender', 'auth_gen', 'total_circ', 'circ_status']
+             if name in scan.collect_schema().names()]
+    scan = (scan.select(names)
+            .filter(pl.col(key).is_not_null() & (pl.col(key) != '')))
+    for df in scan.collect_batches(chunk_size=chunk):
+        columns = {key: df[key].to_list()}
+        for name in names[1:]:
+            if name == 'auth_gen':
+                columns[name] = df[name].to_list()
+            else:
+                columns[name] = df[name].fill_null(0 if name != 'gender' else -1).to_numpy()
+        yield columns
+
+'''
+Per-node aggregates of the items classified in a tree (an LCCTree, a 
+DDCTree or a SharedTree.SharedTree attached in a worker process).
+- direct holds the statistics (see STATS) of the items classified directly
+  at each node, by gender (the last column being items without a gender),
+  with rows in the order of the tree's TreeIndex
+- num_read is the number of items read and unresolved the number that
+  were not resolved to a category
+'''
+class NodeCounts:
+    def __init__(self, tree, key=None):
+        if key is None:
+            key = tree.num_key
+        self.tree = tree
+        self.key = key
+        self.index = tree.get_index()
+        self.direct = np.zeros((len(self.index), len(STATS), len(lt.GENDERS) + 1), dtype=np.int64)
+        self.num_read = 0
+        self.unresolved = 0
+
+    '''
+    Classify a chunk of item columns and add them to the counts
+    '''
+    def add_columns(self, columns):
+        nums = columns[self.key]
+        n = len(nums)
+        with inst.timer('counts.add_columns', n):
+            positions = self.tree.classify(nums)
+            gender = gender_column(columns, n)
+            total_circ = np.asarray(columns.get('total_circ', np.zeros(n)), dtype=np.int64)
+            circ_status = np.asarray(columns.get('circ_status', np.zeros(n)), dtype=np.int64)
+            keep = positions >= 0
+            gender = np.where(gender < 0, NO_GENDER, gender)
+            keys = (positions * (NO_GENDER + 1) + gender)[keep]
+            total_circ = total_circ[keep]
+            size = self.direct.shape[0] * self.direct.shape[2]
+            stats = [np.bincount(keys, minlength=size),
+                     np.bincount(keys, weights=circ_status[keep] > 0, minlength=size),
+                     np.bincount(keys, weights=total_circ > 0, minlength=size),
+                     np.bincount(keys, weights=total_circ, minlength=size)]
+            stats = np.stack(stats).astype(np.int64).reshape((len(STATS),) + self.direct.shape[::2])
+            self.direct += stats.transpose(1, 0, 2)
+            self.num_read += n
+            self.unresolved += n - int(keep.sum())
+
+    '''
+    Add a list of book dicts to the counts
+    '''
+    def add_books(self, books):
+        self.add_columns(book_columns(books, self.key))
+
+    '''
+    Add the items of a Parquet or CSV file, read in chunks of chunk rows
+    '''
+    def add_file(self, fp, chunk=1000000):
+        for columns in iter_chunks(fp, self.key, chunk):
+            self.add_columns(columns)
+
+    '''
+    Add the counts of another NodeCounts of the same tree (i.e. for
+    collections split over several files counted separately)
+    '''
+    def merge(self, other):
+        self.direct += other.direct
+        self.num_read += other.num_read
+        self.unresolved += other.unresolved
+
+    '''
+    Statistics over the subtree of every node (the aggregates that nodes
+    keep when books are added to a tree)
+    '''
+    def subtree(self):
+        return self.index.rollup(self.direct)
+
+    '''
+    Number of items resolved to a category
+    '''
+    @property
+    def item_count(self):
+        return int(self.direct[:, 0].sum())
+
+    '''
+    Set the item counts, gender counts and circulation aggregates of every
+    node of the tree from the counts, so that analyses that only use node
+    aggregates (i.e. ItemBias.depth_hists or NodeQuery.NodeTable) can be run
+    on the tree. Node item lists are left empty.
+    '''
+    def apply(self):
+        sub = self.subtree()
+        item_counts = sub[:, 0].sum(axis=1).tolist()
+        gen_counts = sub[:, 0, :NO_GENDER].tolist()
+        in_circ = sub[:, 1].sum(axis=1).tolist()
+        circ_year = sub[:, 2].sum(axis=1).tolist()
+        total_circ = sub[:, 3].sum(axis=1).tolist()
+        for i, node in enumerate(self.index.nodes):
+            node.item_count = item_counts[i]
+            node.gen_counts = gen_counts[i]
+            node.num_in_circ = in_circ[i]
+            node.circ_year = circ_year[i]
+            node.total_circ = total_circ[i]
+        self.tree.item_count = self.item_count
+
+    '''
+    Circulation statistics for every gender (as returned by
+    ItemBias.circ_stats_by_gender)
+    '''
+    def circ_stats_by_gender(self):
+        stats = self.direct.sum(axis=0)
+        return {gen: stats[:, code] for code, gen in enumerate(lt.GENDERS)}
+
+    '''
+    Depth histograms of items by women and by men (as returned by
+    ItemBias.depth_hists)
+    '''
+    def depth_hists(self):
+        depth = self.index.depth
+        hist_f = np.bincount(depth, weights=self.direct[:, 0, 1]).astype(np.int64)
+        hist_m = np.bincount(depth, weights=self.direct[:, 0, 0]).astype(np.int64)
+        return np.arange(len(hist_f)), hist_f, hist_m
+
+'''
+Count the items of one or more Parquet or CSV files against a tree
+'''
+def count_files(tree, fps, chunk=1000000, key=None):
+    counts = NodeCounts(tree, key)
+    for fp in fps:
+        counts.add_file(fp, chunk)
+    return counts
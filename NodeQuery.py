@@ -0,0 +1,151 @@
+import numpy as np
+from LibraryTree import TreeIndex
+from WesternTagging import west_code
+
+'''
+Queries over the nodes of a library classification tree. The attributes
+of every node are collected into column arrays (a NodeTable) in a single
+pass, and queries are boolean masks over those columns, so any number of
+queries can be answered without walking the tree again.
+
+Queries are built from fields and combined with & (and), | (or) and
+~ (not), i.e. to find nodes with at least 100 books and 2 children:
+    table = NodeTable(tree)
+    mask = table.query((ITEMS >= 100) & (KIDS >= 2))
+'''
+
+'''
+Column arrays of the attributes of every node in a tree (or subtree).
+- item_count, num_kids and depth are the item, child and depth counts
+- num_m, num_f, num_u and num_a count books by male, female, unknown and
+  ambiguous authors
+- west is the west tag of each node coded as 1, 0 or -1 (see WesternTagging.west_code)
+Rows are in the preorder of the tree's TreeIndex.
+'''
+class NodeTable:
+    def __init__(self, tree):
+        if hasattr(tree, 'get_index'):
+            index = tree.get_index()
+        else:
+            index = TreeIndex(tree)
+        self.index = index
+        gen_counts = np.array([node.gen_counts for node in index.nodes], dtype=np.int64)
+        self.columns = {'item_count': index.column('item_count'),
+                        'num_kids': index.num_children(),
+                        'depth': index.depth,
+                        'num_m': gen_counts[:, 0],
+                        'num_f': gen_counts[:, 1],
+                        'num_u': gen_counts[:, 2],
+                        'num_a': gen_counts[:, 3],
+                        'west': np.fromiter((west_code(node.west) for node in index.nodes),
+                                            dtype=np.int8, count=len(index))}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, field):
+        return self.columns[field]
+
+    '''
+    Evaluate one or more queries, returning one mask per query
+    '''
+    def query(self, *queries):
+        masks = [query.mask(self) for query in queries]
+        if len(masks) == 1:
+            return masks[0]
+        return masks
+
+    '''
+    Count the nodes matching each of one or more queries
+    '''
+    def count(self, *queries):
+        counts = [int(query.mask(self).sum()) for query in queries]
+        if len(counts) == 1:
+            return counts[0]
+        return counts
+
+    '''
+    Collect the nodes selected by a mask (in preorder)
+    '''
+    def nodes(self, mask):
+        return [self.index.nodes[i] for i in np.flatnonzero(mask)]
+
+'''
+A condition on the nodes of a NodeTable
+'''
+class Query:
+    def __init__(self, func):
+        self.func = func
+
+    def mask(self, table):
+        return self.func(table)
+
+    def __and__(self, other):
+        return Query(lambda table: self.mask(table) & other.mask(table))
+
+    def __or__(self, other):
+        return Query(lambda table: self.mask(table) | other.mask(table))
+
+    def __invert__(self):
+        return Query(lambda table: ~self.mask(table))
+
+'''
+A column of a NodeTable. Comparing a field to a value gives a Query.
+'''
+class Field:
+    def __init__(self, name):
+        self.name = name
+
+    def __lt__(self, value):
+        return Query(lambda table: table[self.name] < value)
+
+    def __le__(self, value):
+        return Query(lambda table: table[self.name] <= value)
+
+    def __gt__(self, value):
+        return Query(lambda table: table[self.name] > value)
+
+    def __ge__(self, value):
+        return Query(lambda table: table[self.name] >= value)
+
+    def __eq__(self, value):
+        return Query(lambda table: table[self.name] == value)
+
+    def __ne__(self, value):
+        return Query(lambda table: table[self.name] != value)
+
+ITEMS = Field('item_count')
+KIDS = Field('num_kids')
+DEPTH = Field('depth')
+MALE = Field('num_m')
+FEMALE = Field('num_f')
+UNKNOWN = Field('num_u')
+AMBIGUOUS = Field('num_a')
+
+'''
+Nodes tagged as western (west=True), non-western (west=False) or neither
+(west=None)
+'''
+def west(flag):
+    return Query(lambda table: table['west'] == west_code(flag))
+
+'''
+Nodes in the subtree rooted at a node (including the node itself)
+'''
+def within(node):
+    def mask(table):
+        start = table.index.position(node)
+        out = np.zeros(len(table), dtype=bool)
+        out[start:table.index.end[start]] = True
+        return out
+    return Query(mask)
+
+'''
+The root of the table
+'''
+def is_root():
+    def mask(table):
+        out = np.zeros(len(table), dtype=bool)
+        out[0] = True
+        return out
+    return Query(mask)
@@ -0,0 +1,109 @@
+import os
+import json
+import hashlib
+import numpy as np
+import Instrument as inst
+
+'''
+Persistent store for permutation test results. Null distributions are
+saved to disk so that rerunning a test with the same inputs and seed
+reuses them, interrupted runs resume from their last checkpoint, and a
+test can be extended (i.e. from 10,000 to 100,000 permutations) by only
+computing the permutations that are missing.
+
+Permutations are drawn in fixed-size blocks and every block has its own
+random stream (derived from the seed and the block number), so the first
+n permutations of a run are the same however many runs it took to get
+there. A run is therefore stored under a hash of the test name, the input
+arrays, the seed and the block size, and the p-value for each requested
+number of permutations is recorded alongside the null distribution.
+'''
+class PermStore:
+    def __init__(self, folder, block=1000, checkpoint=10):
+        self.folder = folder
+        # number of permutations per block
+        self.block = block
+        # number of blocks computed between saves
+        self.checkpoint = checkpoint
+        os.makedirs(folder, exist_ok=True)
+
+    '''
+    Hash the name of a test, its inputs and its seed
+    '''
+    def key(self, name, arrays, seed):
+        h = hashlib.sha256()
+        h.update(name.encode())
+        for arr in arrays:
+            arr = np.ascontiguousarray(arr)
+            h.update(str((arr.dtype.str, arr.shape)).encode())
+            h.update(arr.tobytes())
+        h.update(str((seed, self.block)).encode())
+        return h.hexdigest()[:32]
+
+    def paths(self, key):
+        base = os.path.join(self.folder, key)
+        return base + '.npy', base + '.json'
+
+    '''
+    Load the null distribution and metadata stored for a key
+    '''
+    def load(self, key):
+        null_fp, meta_fp = self.paths(key)
+        if not os.path.exists(null_fp) or not os.path.exists(meta_fp):
+            return np.empty(0), {'p_values': {}}
+        with open(meta_fp, 'r') as f:
+            meta = json.load(f)
+        null = np.load(null_fp)
+        # only trust the permutations recorded as complete in the metadata
+        return null[:meta['done']], meta
+
+    '''
+    Write the null distribution and metadata for a key. Files are written
+    to a temporary path first so an interrupted save never corrupts a run.
+    '''
+    def save(self, key, null, meta):
+        null_fp, meta_fp = self.paths(key)
+        meta['done'] = len(null)
+        with open(null_fp + '.tmp', 'wb') as f:
+            np.save(f, null)
+        os.replace(null_fp + '.tmp', null_fp)
+        with open(meta_fp + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(meta_fp + '.tmp', meta_fp)
+
+    '''
+    Run (or resume, or extend) a permutation test.
+    - name identifies the test
+    - arrays are the inputs the null distribution depends on
+    - draw_null(rng, size) returns size permuted statistics drawn with the
+      numpy Generator rng
+    - observed is the attested statistic; permuted statistics that are at
+      least as large count towards the p-value
+    - perms is the number of permutations
+    Returns the p-value and the null distribution.
+    '''
+    def run(self, name, arrays, draw_null, observed, perms, seed=0, tol=1e-12):
+        key = self.key(name, arrays, seed)
+        null, meta = self.load(key)
+        meta['name'] = name
+        meta['seed'] = seed
+        blocks = [null]
+        done = len(null) // self.block
+        needed = -(-perms // self.block)
+        inst.count('perm_store.cached_perms', min(len(null), perms))
+        with inst.timer('perm_store.run', max(needed - done, 0) * self.block):
+            for b in range(done, needed):
+                rng = np.random.default_rng([seed, b])
+                blocks.append(np.asarray(draw_null(rng, self.block), dtype=np.float64))
+                if (b + 1 - done) % self.checkpoint == 0:
+                    null = np.concatenate(blocks)
+                    blocks = [null]
+                    self.save(key, null, meta)
+        # whole blocks are kept so later runs can pick up where this one stopped
+        null = np.concatenate(blocks)
+        # tolerance so permutations that reproduce the observed split count
+        # despite rounding differences between the scalar and batch statistics
+        p_val = float(np.mean(null[:perms] >= observed - tol))
+        meta['p_values'][str(perms)] = p_val
+        self.save(key, null, meta)
+        return p_val, null[:perms]
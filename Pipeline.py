@@ -0,0 +1,432 @@
+import os
+import sys
+import json
+import pickle
+import hashlib
+import inspect
+import argparse
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import LibraryTree as lt
+import WesternTagging as wt
+import CategoryBias as cb
+import ItemBias as ib
+import BatchStats as bs
+from PermCache import PermStore
+
+'''
+Command line pipeline for the western category bias and item gender bias
+analyses in "Quantifying Library Bias.ipynb". The analysis is split into
+stages that form a DAG (loading the MARC records, tagging author genders,
+building the trees and running the analyses for each classification
+system). Each stage has a key: a hash of its code, its parameters, the
+contents of its input files and the keys of the stages it depends on. The
+output (artifact) of a stage is saved under its key, so a rerun only runs
+the stages whose inputs have changed, and stages that do not depend on each
+other run concurrently.
+
+Run from the command line, i.e.
+    python Pipeline.py --marc marcData.pk --genders authorGender.pk --out results
+Several MARC extracts can be given at once; their results are written to
+a folder per extract and they share the cache.
+'''
+
+FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Data', 'Library Data')
+# source files of the pipeline and the analysis code it imports (a change to 
+# any of them reruns every stage)
+CODE_FILES = ['Pipeline.py', 'LibraryTree.py', 'WesternTagging.py', 'CategoryBias.py',
+              'ItemBias.py', 'BatchStats.py', 'NodeQuery.py', 'PermCache.py', 'Instrument.py']
+
+# Domains analysed in each classification system, as in the notebook
+DOMAINS = {'lcc': {'Religion': ['B'], 'Lang. & Lit.': ['P'], 'History': ['D', 'E', 'F']},
+           'ddc': {'Religion': ['2'], 'Lang. & Lit.': ['4', '8'], 'History': ['9']}}
+
+'''
+A stage of the pipeline.
+- func(inputs, params) computes the stage's artifact from the artifacts of
+  the stages it depends on (inputs, keyed by input name) and its parameters
+- deps maps the names of its inputs to the stages they come from (a list
+  of stage names can be given if the inputs are named after the stages)
+- params are its parameters; the contents of files named by the parameters
+  in files are part of its key
+- cache is False for stages whose artifacts are not saved (i.e. trees,
+  which are quicker to rebuild than to load)
+'''
+class Stage:
+    def __init__(self, name, func, deps=(), params=None, files=(), cache=True):
+        self.name = name
+        self.func = func
+        self.deps = dict(deps) if isinstance(deps, dict) else {dep: dep for dep in deps}
+        self.params = {} if params is None else params
+        self.files = list(files)
+        self.cache = cache
+
+'''
+Hash the contents of a file. Hashes are remembered by path, size and
+modification time so large files are only read again when they change.
+'''
+def file_hash(fp, memo):
+    fp = os.path.abspath(fp)
+    stat = os.stat(fp)
+    entry = memo.get(fp)
+    if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+        return entry['hash']
+    h = hashlib.sha256()
+    with open(fp, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            h.update(block)
+    memo[fp] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'hash': h.hexdigest()}
+    return memo[fp]['hash']
+
+'''
+Hash the contents of a file or of every file in a folder
+'''
+def path_hash(path, memo):
+    if not os.path.isdir(path):
+        return file_hash(path, memo)
+    h = hashlib.sha256()
+    for subdir, _, files in sorted(os.walk(path)):
+        for file in sorted(files):
+            fp = os.path.join(subdir, file)
+            h.update(os.path.relpath(fp, path).encode())
+            h.update(file_hash(fp, memo).encode())
+    return h.hexdigest()
+
+def code_hash():
+    h = hashlib.sha256()
+    folder = os.path.dirname(os.path.abspath(__file__))
+    for file in CODE_FILES:
+        with open(os.path.join(folder, file), 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+'''
+Runs a DAG of stages with a cache of artifacts in a folder
+'''
+class Pipeline:
+    def __init__(self, stages, cache_folder, workers=1, log=sys.stderr):
+        self.stages = {stage.name: stage for stage in stages}
+        self.cache_folder = cache_folder
+        self.workers = workers
+        self.log = log
+        os.makedirs(cache_folder, exist_ok=True)
+        self.memo_fp = os.path.join(cache_folder, 'file_hashes.json')
+        self.memo = {}
+        if os.path.exists(self.memo_fp):
+            with open(self.memo_fp, 'r') as f:
+                self.memo = json.load(f)
+        self.code = code_hash()
+
+    def message(self, text):
+        if self.log is not None:
+            self.log.write(text + '\n')
+
+    '''
+    Stages in an order where every stage comes after its dependencies
+    '''
+    def order(self):
+        done, order = set(), []
+        def visit(name, path):
+            if name in path:
+                raise ValueError(f'Cycle in pipeline at stage {name}')
+            if name in done:
+                return
+            for dep in self.stages[name].deps.values():
+                visit(dep, path | {name})
+            done.add(name)
+            order.append(name)
+        for name in self.stages:
+            visit(name, set())
+        return order
+
+    '''
+    Compute the key of every stage
+    '''
+    def keys(self):
+        keys = {}
+        for name in self.order():
+            stage = self.stages[name]
+            h = hashlib.sha256()
+            h.update(name.encode())
+            h.update(self.code.encode())
+            h.update(inspect.getsource(inspect.unwrap(stage.func)).encode())
+            params = {param: (path_hash(val, self.memo) if param in stage.files else val)
+                      for param, val in stage.params.items()}
+            h.update(json.dumps(params, sort_keys=True, default=str).encode())
+            for role, dep in sorted(stage.deps.items()):
+                h.update(role.encode())
+                h.update(keys[dep].encode())
+            keys[name] = h.hexdigest()[:32]
+        with open(self.memo_fp + '.tmp', 'w') as f:
+            json.dump(self.memo, f)
+        os.replace(self.memo_fp + '.tmp', self.memo_fp)
+        return keys
+
+    def artifact_path(self, name, key):
+        return os.path.join(self.cache_folder, f"{name.replace('/', '__')}-{key}.pk")
+
+    def is_cached(self, name, key):
+        return self.stages[name].cache and os.path.exists(self.artifact_path(name, key))
+
+    def load(self, name, key):
+        with open(self.artifact_path(name, key), 'rb') as f:
+            return pickle.load(f)
+
+    def save(self, name, key, artifact):
+        fp = self.artifact_path(name, key)
+        with open(fp + '.tmp', 'wb') as f:
+            pickle.dump(artifact, f)
+        os.replace(fp + '.tmp', fp)
+
+    '''
+    Work out which stages have to run to produce the targets: stages that
+    are not cached, and the dependencies of stages that run. Cached stages
+    that a running stage depends on are loaded.
+    '''
+    def plan(self, targets, keys):
+        run, load = set(), set()
+        def visit(name):
+            if name in run or name in load:
+                return
+            if self.is_cached(name, keys[name]):
+                load.add(name)
+                return
+            run.add(name)
+            for dep in self.stages[name].deps.values():
+                visit(dep)
+        for target in targets:
+            visit(target)
+        return run, load
+
+    '''
+    Run the pipeline, returning the artifacts of the targets (default all
+    stages no other stage depends on)
+    '''
+    def run(self, targets=None):
+        if targets is None:
+            deps = {dep for stage in self.stages.values() for dep in stage.deps.values()}
+            targets = [name for name in self.stages if name not in deps]
+        keys = self.keys()
+        run, load = self.plan(targets, keys)
+        artifacts = {}
+        for name in load:
+            if name in targets or any(name in self.stages[other].deps.values() for other in run):
+                self.message(f'[cached] {name}')
+                artifacts[name] = self.load(name, keys[name])
+        pending = [name for name in self.order() if name in run]
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            running = {}
+            while pending or running:
+                # start every stage whose dependencies are done
+                for name in list(pending):
+                    if all(dep in artifacts for dep in self.stages[name].deps.values()):
+                        pending.remove(name)
+                        stage = self.stages[name]
+                        inputs = {role: artifacts[dep] for role, dep in stage.deps.items()}
+                        self.message(f'[run] {name}')
+                        running[pool.submit(stage.func, inputs, stage.params)] = name
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    artifacts[name] = future.result()
+                    if self.stages[name].cache:
+                        self.save(name, keys[name], artifacts[name])
+                    self.message(f'[done] {name}')
+        return {name: artifacts[name] for name in targets}
+
+'''
+STAGES
+
+Load MARC records, keep books with a valid LCC and DDC number whose LCC
+number resolves to a category (as in the notebook). Classification
+categories are not kept so the artifact does not hold the tree.
+'''
+def load_books(inputs, params):
+    with open(params['marc'], 'rb') as f:
+        books = pickle.load(f)
+    books = lt.extract_class_num(books)
+    lcc = lt.LCCTree(params['lcc_folder'])
+    valid = [book for book in books if book['lcc'] is not None and lcc.validate_lcc(book['lcc'])
+             and book['ddc'] is not None and lt.validate_ddc(book['ddc'])]
+    lcc.add_books(valid)
+    return [{key: val for key, val in book.items() if key != 'lcc_cat'}
+            for book in lcc.root.items]
+
+'''
+Gender code of each book's author (-1 for books without an author in
+their MARC record or in the VIAF lookup)
+'''
+def tag_genders(inputs, params):
+    with open(params['genders'], 'rb') as f:
+        lookup = pickle.load(f)
+    books = [dict(book) for book in inputs['books']]
+    codes, _, _ = ib.tag_books_batch(books, ib.build_gender_table(lookup))
+    return codes
+
+'''
+Build a tree with a copy of the books (books are copied so trees built
+concurrently do not overwrite each other's categories)
+'''
+def build_tree(system, folder, books):
+    if system == 'lcc':
+        tree = lt.LCCTree(os.path.join(folder, 'LCC Outlines'))
+    else:
+        tree = lt.DDCTree(os.path.join(folder, 'DDC'))
+    tree.add_books([dict(book) for book in books])
+    return tree
+
+def category_tree(inputs, params):
+    tree = build_tree(params['system'], params['folder'], inputs['books'])
+    if params['system'] == 'lcc':
+        wt.tag_lcc(tree)
+    else:
+        wt.tag_dewey(tree)
+    return tree
+
+def item_tree(inputs, params):
+    books = []
+    for book, code in zip(inputs['books'], inputs['genders'].tolist()):
+        if code >= 0:
+            books.append(dict(book, auth_gen=lt.GENDERS[code]))
+    tree = build_tree(params['system'], params['folder'], books)
+    ib.tag_tree_fm(tree)
+    return tree
+
+'''
+Western category bias metrics and permutation tests for each domain (and
+all domains together)
+'''
+def category_analysis(inputs, params):
+    tree = inputs['tree']
+    system = 'lcc' if isinstance(tree, lt.LCCTree) else 'ddc'
+    index = tree.get_index()
+    domains = {}
+    for name, labels in DOMAINS[system].items():
+        roots = [tree.root.children[label] for label in labels]
+        domains[name] = (wt.parse_west_view(roots, True, index),
+                         wt.parse_west_view(roots, False, index))
+    domains['Overall'] = (sum([w for w, _ in domains.values()], []),
+                          sum([nw for _, nw in domains.values()], []))
+    results = {}
+    for name, (west, nonwest) in domains.items():
+        avg_w, avg_nw = cb.level_bias1(west, nonwest)
+        w_levels, nw_levels = cb.get_level_dist(west), cb.get_level_dist(nonwest)
+        uniq = np.unique(w_levels + nw_levels)
+        hist_w = np.array([w_levels.count(lev) for lev in uniq])
+        hist_nw = np.array([nw_levels.count(lev) for lev in uniq])
+        observed, p_vals, adj_p_vals = cb.joint_perm_test(west, nonwest, params['perms'],
+                                                          seed=params['seed'])
+        results[name] = {'num_nodes': [len(west), len(nonwest)],
+                         'items_per_node': [cb.avg_items_per_node(west),
+                                            cb.avg_items_per_node(nonwest)],
+                         'mean_depth': [avg_w, avg_nw],
+                         'jsd': cb.get_jsd(w_levels, nw_levels),
+                         'prob_nw_deeper': float(bs.hist_prob_deeper(hist_w, hist_nw)),
+                         'num_start': [cb.avg_descendants(west)[1], cb.avg_descendants(nonwest)[1]],
+                         'mean_desc': [cb.avg_descendants(west)[0], cb.avg_descendants(nonwest)[0]],
+                         'items_per_start': [cb.mean_items_per_start(west),
+                                             cb.mean_items_per_start(nonwest)],
+                         'circ': [cb.get_anual_circ(west), cb.get_anual_circ(nonwest)],
+                         'p_values': p_vals,
+                         'adj_p_values': adj_p_vals}
+    return results
+
+'''
+Item gender bias: circulation, depth and distributional bias
+'''
+def item_analysis(inputs, params):
+    tree = inputs['tree']
+    store = None if params['perm_folder'] is None else PermStore(params['perm_folder'])
+    levels, hist_f, hist_m = ib.depth_hists(tree)
+    mean_f = float(bs.hist_mean(hist_f, levels))
+    mean_m = float(bs.hist_mean(hist_m, levels))
+    diff = abs(mean_f - mean_m)
+    prob_f = ib.prob_f_deeper(hist_f, hist_m)
+    _, _, _, flatter = ib.dist_bias_arrays(tree, 100, 2)
+    kids, items, no_women, no_men = ib.constraint_summary(tree, 100, 2)
+    circ = ib.circ_stats_by_gender(tree)
+    return {'circ': {gen: stats.tolist() for gen, stats in circ.items()},
+            'mean_depth': [mean_f, mean_m],
+            'mean_depth_p': ib.mean_perm_test(levels, hist_f, hist_m, diff, params['perms'],
+                                              store, params['seed']),
+            'prob_f_deeper': prob_f,
+            'prob_f_deeper_p': ib.deeper_perm_test(hist_f, hist_m, prob_f, params['perms'],
+                                                   store, params['seed']),
+            'flatter': {'female': flatter[0], 'male': flatter[1]},
+            'constraints': {'few_kids': kids, 'few_items': items, 'no_women': no_women,
+                            'no_men': no_men, 'total': tree.node_count}}
+
+'''
+Write the results of the analysis stages to results.json in the output
+folder
+'''
+def write_report(inputs, params):
+    os.makedirs(params['out'], exist_ok=True)
+    fp = os.path.join(params['out'], 'results.json')
+    with open(fp, 'w') as f:
+        json.dump(inputs, f, indent=1, default=lambda val: val.item()
+                  if hasattr(val, 'item') else str(val))
+    return fp
+
+'''
+Build the stages for one MARC extract. Stage names are prefixed with the
+extract's name (name) so several extracts can share a pipeline. Item gender 
+bias stages are only included if an author gender lookup is given.
+'''
+def make_stages(marc, out, genders=None, folder=FOLDER, perms=10000, seed=0,
+                perm_folder=None, name=''):
+    prefix = name + '/' if name else ''
+    books = prefix + 'books'
+    stages = [Stage(books, load_books, [],
+                    {'marc': marc, 'lcc_folder': os.path.join(folder, 'LCC Outlines')},
+                    files=['marc', 'lcc_folder'])]
+    results = {}
+    for system in ['lcc', 'ddc']:
+        tree = prefix + f'{system}_category_tree'
+        stages.append(Stage(tree, category_tree, {'books': books},
+                            {'system': system, 'folder': folder}, files=['folder'], cache=False))
+        stages.append(Stage(prefix + f'{system}_category', category_analysis, {'tree': tree},
+                            {'perms': perms, 'seed': seed}))
+        results[f'{system}_category'] = prefix + f'{system}_category'
+    if genders is not None:
+        stages.append(Stage(prefix + 'genders', tag_genders, {'books': books},
+                            {'genders': genders}, files=['genders']))
+        for system in ['lcc', 'ddc']:
+            tree = prefix + f'{system}_item_tree'
+            stages.append(Stage(tree, item_tree, {'books': books, 'genders': prefix + 'genders'},
+                                {'system': system, 'folder': folder}, files=['folder'],
+                                cache=False))
+            stages.append(Stage(prefix + f'{system}_item', item_analysis, {'tree': tree},
+                                {'perms': perms, 'seed': seed, 'perm_folder': perm_folder}))
+            results[f'{system}_item'] = prefix + f'{system}_item'
+    stages.append(Stage(prefix + 'report', write_report, results, {'out': out}, cache=False))
+    return stages
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the library bias analyses')
+    parser.add_argument('--marc', nargs='+', required=True,
+                        help='pickled MARC extracts (i.e. marcData.pk)')
+    parser.add_argument('--genders', default=None,
+                        help='pickled author gender lookup (i.e. authorGender.pk)')
+    parser.add_argument('--data', default=FOLDER,
+                        help='folder with the LCC Outlines and DDC folders')
+    parser.add_argument('--out', default='results', help='output folder')
+    parser.add_argument('--cache', default=None, help='cache folder (default OUT/.cache)')
+    parser.add_argument('--perms', type=int, default=10000, help='permutations per test')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args(argv)
+
+    cache = args.cache if args.cache is not None else os.path.join(args.out, '.cache')
+    stages = []
+    for marc in args.marc:
+        name = os.path.splitext(os.path.basename(marc))[0] if len(args.marc) > 1 else ''
+        stages += make_stages(marc, os.path.join(args.out, name), args.genders, args.data,
+                              args.perms, args.seed, os.path.join(cache, 'perms'), name)
+    pipeline = Pipeline(stages, cache, args.workers)
+    for fp in pipeline.run().values():
+        print(fp)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
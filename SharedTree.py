@@ -0,0 +1,302 @@
+import numpy as np
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+import LibraryTree as lt
+import NodeCounts as nc
+
+'''
+Read-only copies of LCCTree and DDCTree in shared memory for process pools.
+Pickling a tree into every worker is slow (the object graph is deep enough
+to hit the recursion limit) and rebuilding it in every worker multiplies
+its memory by the number of workers. Instead, the structure of a tree (its
+TreeIndex arrays and labels) and the lookup tables used to classify class
+numbers are flattened into arrays and published once into a single
+shared memory block. Workers attach zero-copy, read-only views of the
+arrays from a small picklable spec and keep only their own count arrays,
+i.e.
+    shared = publish(lcc)
+    with ProcessPoolExecutor(initializer=attach_worker, initargs=(shared.spec,)) as pool:
+        ...
+    shared.unlink()
+
+A SharedTree classifies numbers like the tree it was published from (see
+LCCTree.classify and DDCTree.classify) and has the TreeIndex attributes
+used by NodeCounts (depth, parent, end, rollup), so NodeCounts can be used
+with it in workers.
+'''
+
+# tree attached in a worker process by attach_worker
+WORKER_TREE = None
+
+'''
+Flatten the hash table of an LCC tree into arrays. Every subclass that
+LCCTree.find_category looks up gets a key (its main class followed by its
+subclass letters, if any) with the position of its default category and
+the slice of its numeric ranges (lo, hi and the position of the category
+of each range, in hash table order).
+'''
+def lcc_lookup(tree, index):
+    keys, key_node, key_start, key_end = [], [], [], []
+    lo, hi, pos = [], [], []
+    for mainCls, subClasses in tree.labels.items():
+        for subCls in subClasses:
+            try:
+                nodes, node = tree.subclass_entry(mainCls, subCls)
+            except KeyError:
+                continue
+            keys.append(mainCls + ('' if subCls is None else subCls))
+            key_node.append(-1 if node is None else index.position(node))
+            key_start.append(len(lo))
+            for label, child in nodes.items():
+                if label != 'node':
+                    lo.append(label[0])
+                    hi.append(label[1])
+                    pos.append(index.position(child))
+            key_end.append(len(lo))
+    order = np.argsort(np.array(keys), kind='stable')
+    return {'keys': np.array(keys)[order],
+            'key_node': np.array(key_node, dtype=np.int64)[order],
+            'key_start': np.array(key_start, dtype=np.int64)[order],
+            'key_end': np.array(key_end, dtype=np.int64)[order],
+            'range_lo': np.array(lo, dtype=np.float64),
+            'range_hi': np.array(hi, dtype=np.float64),
+            'range_pos': np.array(pos, dtype=np.int64)}
+
+'''
+Flatten the categories of a DDC tree into their digits (the number without
+its decimal point, see DeweyNode.parse) in sorted order and their positions
+'''
+def ddc_lookup(index):
+    parse = np.array([node.parse for node in index.nodes[1:]])
+    order = np.argsort(parse, kind='stable')
+    return {'keys': parse[order], 'key_pos': order.astype(np.int64) + 1}
+
+'''
+Collect the arrays of a tree: its TreeIndex layout, its labels and its
+lookup tables
+'''
+def tree_arrays(tree):
+    index = tree.get_index()
+    arrays = {'parent': index.parent, 'depth': index.depth, 'end': index.end,
+              'child_ptr': index.child_ptr, 'child_idx': index.child_idx,
+              'labels': np.array([str(node.label) for node in index.nodes])}
+    if tree.num_key == 'lcc':
+        arrays.update(lcc_lookup(tree, index))
+    else:
+        arrays.update(ddc_lookup(index))
+    return arrays
+
+'''
+Copy arrays into a new shared memory block. Returns the block and the
+layout of the arrays in it as (name, dtype, shape, offset) tuples.
+'''
+def share_arrays(arrays):
+    layout, offset = [], 0
+    for name, arr in arrays.items():
+        layout.append((name, arr.dtype.str, arr.shape, offset))
+        # keep every array 8-byte aligned
+        offset += -(-arr.nbytes // 8) * 8
+    shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    for (name, dtype, shape, start), arr in zip(layout, arrays.values()):
+        np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=start)[...] = arr
+    return shm, layout
+
+'''
+Read-only view of a tree in shared memory. Create one with publish (which
+owns the block and must unlink it when done) and attach to it in other
+processes with SharedTree.attach(spec).
+'''
+class SharedTree:
+    def __init__(self, shm, num_key, layout, owner=False):
+        self.shm = shm
+        self.num_key = num_key
+        self.layout = layout
+        self.owner = owner
+        self.arrays = {}
+        for name, dtype, shape, offset in layout:
+            arr = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+            arr.flags.writeable = False
+            self.arrays[name] = arr
+        self.parent = self.arrays['parent']
+        self.depth = self.arrays['depth']
+        self.end = self.arrays['end']
+        self.child_ptr = self.arrays['child_ptr']
+        self.child_idx = self.arrays['child_idx']
+        self.labels = self.arrays['labels']
+
+    '''
+    Picklable description of the block, passed to workers to attach
+    '''
+    @property
+    def spec(self):
+        return (self.shm.name, self.num_key, self.layout)
+
+    @classmethod
+    def attach(cls, spec):
+        name, num_key, layout = spec
+        return cls(shared_memory.SharedMemory(name=name), num_key, layout)
+
+    def __len__(self):
+        return len(self.parent)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        if self.owner:
+            self.unlink()
+        return False
+
+    '''
+    The tree is its own index (for NodeCounts)
+    '''
+    def get_index(self):
+        return self
+
+    # LCC numbers are split into their components as in LCCTree
+    getComponents = lt.LCCTree.getComponents
+    getDivision = staticmethod(lt.LCCTree.getDivision)
+    rollup = lt.TreeIndex.rollup
+    num_children = lt.TreeIndex.num_children
+    num_descendants = lt.TreeIndex.num_descendants
+
+    '''
+    Find the position of a category from its label
+    '''
+    def position(self, label):
+        return int(np.flatnonzero(self.labels == label)[0])
+
+    '''
+    Classify a sequence of class numbers, returning the position of the
+    deepest category of each (-1 if it is not resolved to one). Each
+    distinct number is only looked up once.
+    '''
+    def classify(self, nums):
+        uniq, inverse = np.unique(np.asarray(nums, dtype=str), return_inverse=True)
+        if self.num_key == 'lcc':
+            found = self.classify_lcc(uniq.tolist())
+        else:
+            found = self.classify_ddc(uniq.tolist())
+        return found[inverse.reshape(-1)]
+
+    '''
+    Classify distinct LCC numbers as LCCTree.find_category does: look up
+    the subclass, then take the smallest numeric range holding the division
+    (the last such range in hash table order if there are ties). Subclasses
+    are looked up for all the numbers with one search of the sorted keys,
+    then every (number, range of its subclass) pair is matched at once, at
+    most max_pairs pairs at a time.
+    '''
+    def classify_lcc(self, nums, max_pairs=2**22):
+        arrays = self.arrays
+        keys = arrays['keys']
+        found = np.full(len(nums), -1, dtype=np.int64)
+        if len(nums) == 0 or len(keys) == 0:
+            return found
+        query, div = [], np.empty(len(nums), dtype=np.float64)
+        for j, lcc in enumerate(nums):
+            mainCls, subCls, division = self.getComponents(lcc)
+            query.append(mainCls + ('' if subCls is None else subCls))
+            div[j] = np.nan if division is None else division
+        query = np.array(query, dtype=keys.dtype)
+        k = np.minimum(np.searchsorted(keys, query), len(keys) - 1)
+        hit = keys[k] == query
+        found[hit] = arrays['key_node'][k[hit]]
+        # numbers with a division are matched against the ranges of their subclass
+        todo = np.flatnonzero(hit & ~np.isnan(div))
+        start = arrays['key_start'][k[todo]]
+        counts = arrays['key_end'][k[todo]] - start
+        bounds = np.searchsorted(np.cumsum(counts), np.arange(max_pairs, counts.sum(), max_pairs), 
+                                 side='right')
+        for part in np.split(np.arange(len(todo)), bounds):
+            part_counts = counts[part]
+            owner = np.repeat(part, part_counts)
+            first = np.repeat(np.cumsum(part_counts) - part_counts, part_counts)
+            ranges = start[owner] + np.arange(len(owner)) - first
+            lo, hi = arrays['range_lo'][ranges], arrays['range_hi'][ranges]
+            diff = hi - lo
+            d = div[todo[owner]]
+            match = (lo <= d) & (d <= hi) & (diff <= 9999)
+            owner, ranges, diff = owner[match], ranges[match], diff[match]
+            # smallest range per number, the last in hash table order if tied
+            order = np.lexsort((-ranges, diff, owner))
+            owner, first = np.unique(owner[order], return_index=True)
+            found[todo[owner]] = arrays['range_pos'][ranges[order[first]]]
+        return found
+
+    '''
+    Classify distinct DDC numbers as DDCTree.find_category does: the deepest
+    category whose digits are a prefix of the number's digits (-1 if there
+    is none). Categories are matched one level at a time for all the
+    numbers at once.
+    '''
+    def classify_ddc(self, nums):
+        keys, key_pos = self.arrays['keys'], self.arrays['key_pos']
+        digits = [num.replace('.', '') for num in nums]
+        found = np.full(len(nums), -1, dtype=np.int64)
+        active = np.arange(len(nums))
+        level = 1
+        while len(active) > 0 and len(keys) > 0:
+            active = active[[len(digits[j]) >= level for j in active]]
+            prefixes = np.array([digits[j][:level] for j in active], dtype=keys.dtype)
+            k = np.minimum(np.searchsorted(keys, prefixes), len(keys) - 1)
+            hit = keys[k] == prefixes
+            found[active[hit]] = key_pos[k[hit]]
+            active = active[hit]
+            level += 1
+        return found
+
+    def close(self):
+        self.arrays = {}
+        self.parent = self.depth = self.end = self.child_ptr = self.child_idx = self.labels = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+'''
+Publish a tree into shared memory. The returned SharedTree owns the block:
+call unlink (or use it as a context manager) once the workers are done.
+'''
+def publish(tree):
+    shm, layout = share_arrays(tree_arrays(tree))
+    return SharedTree(shm, tree.num_key, layout, owner=True)
+
+'''
+Process pool initializer attaching a published tree in a worker
+'''
+def attach_worker(spec):
+    global WORKER_TREE
+    WORKER_TREE = SharedTree.attach(spec)
+
+'''
+Count the items of a file against the tree attached in a worker. Returns
+only the count arrays (see NodeCounts).
+'''
+def count_file_job(fp, chunk):
+    counts = nc.NodeCounts(WORKER_TREE)
+    counts.add_file(fp, chunk)
+    return counts.direct, counts.num_read, counts.unresolved
+
+'''
+Count the items of several Parquet or CSV files (i.e. the holdings of
+several libraries) against a tree in a process pool. The tree is
+published once and shared by the workers. Returns one NodeCounts of the
+tree per file.
+'''
+def count_files_parallel(tree, fps, chunk=1000000, workers=None):
+    with publish(tree) as shared:
+        # workers are spawned, not forked: polars' thread pool does not survive a fork
+        with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context('spawn'),
+                                 initializer=attach_worker, initargs=(shared.spec,)) as pool:
+            results = list(pool.map(count_file_job, fps, [chunk] * len(fps)))
+    all_counts = []
+    for direct, num_read, unresolved in results:
+        counts = nc.NodeCounts(tree)
+        counts.direct += direct
+        counts.num_read = num_read
+        counts.unresolved = unresolved
+        all_counts.append(counts)
+    return all_counts
@@ -0,0 +1,177 @@
+import numpy as np
+import LibraryTree as lt
+
+'''
+Synthetic catalogues for testing and benchmarking without the OhioLINK MARC
+data. Books are given LCC numbers sampled from the ranges of the numbered
+categories in the LCC outlines and DDC numbers sampled from the categories
+of the DDC tree, along with an author gender and circulation fields. Books
+look like the processed records in marcData.pk (see
+LibraryTree.extract_class_num), so they can be added to LCCTree and DDCTree
+instances and used with the category and item bias analyses.
+
+Category sizes in a real catalogue are very uneven, so each category is
+given a random weight (lognormal with standard deviation skew) and books
+are assigned to categories in proportion to those weights.
+'''
+
+# probability of each gender in LibraryTree.GENDERS
+GEN_PROBS = [0.60, 0.25, 0.10, 0.05]
+
+'''
+Collect the numbered LCC categories that books can be sampled from as the
+label prefixes (i.e. 'BL') and (min, max) ranges of their numbers
+'''
+def lcc_candidates(tree):
+    prefixes, mins, maxs = [], [], []
+    for node in tree.get_index().nodes:
+        # skip categories whose labels do not give a valid range
+        if isinstance(node, lt.NumNode) and node.minVal <= node.maxVal:
+            prefix = node.label[:lt.getDigitIdx(node.label)]
+            if tree.validate_lcc(prefix + '1'):
+                prefixes.append(prefix)
+                mins.append(node.minVal)
+                maxs.append(node.maxVal)
+    return np.array(prefixes), np.array(mins), np.array(maxs)
+
+'''
+Collect the labels of the DDC categories that books can be sampled from
+(categories at a depth of 3 or more)
+'''
+def ddc_candidates(tree):
+    return np.array([node.label for node in tree.get_index().nodes if node.depth >= 3])
+
+'''
+Format sampled LCC numbers: a prefix, a class number with 0 to 2 decimals
+(kept within the range of its category) and, for some books, a cutter 
+number (i.e. 'BL685.5.A12')
+'''
+def format_lcc(rng, prefixes, vals, mins, maxs):
+    decimals = rng.choice(3, size=len(vals), p=[0.6, 0.25, 0.15])
+    cutters = rng.random(len(vals)) < 0.5
+    letters = rng.integers(ord('A'), ord('Z') + 1, size=len(vals))
+    digits = rng.integers(1, 100, size=len(vals))
+    nums = []
+    for prefix, val, lo, hi, dec, cut, let, dig in zip(prefixes.tolist(), vals.tolist(),
+                                                       mins.tolist(), maxs.tolist(),
+                                                       decimals.tolist(), cutters.tolist(),
+                                                       letters.tolist(), digits.tolist()):
+        num = f'{val:.{dec}f}'
+        if not lo <= float(num) <= hi:
+            num = f'{val:.2f}'
+        num = prefix + num
+        if cut:
+            num += f'.{chr(let)}{dig}'
+        nums.append(num)
+    return nums
+
+'''
+Format sampled DDC numbers, extending half of them with up to 3 random
+digits beyond their category (i.e. '299' becomes '299.14')
+'''
+def format_ddc(rng, labels):
+    extend = rng.integers(0, 4, size=len(labels)) * (rng.random(len(labels)) < 0.5)
+    extra = rng.integers(0, 1000, size=len(labels))
+    nums = []
+    for label, ext, digits in zip(labels.tolist(), extend.tolist(), extra.tolist()):
+        if ext > 0:
+            digits = f'{digits:03d}'[:ext]
+            label += digits if '.' in label else '.' + digits
+        nums.append(label)
+    return nums
+
+'''
+Sampler for the books of a synthetic catalogue.
+- lcc and ddc are the trees whose categories are sampled
+- skew sets how uneven category sizes are (0 for uniform)
+- gen_probs is the probability of each author gender and no_auth the
+  probability that a book has no author (and so no gender)
+- p_circ is the probability that a book is in circulation, p_taken the
+  probability that a circulating book has been taken out and mean_circ
+  the mean number of times a book that has been taken out circulated
+'''
+class CatalogueSampler:
+    def __init__(self, lcc, ddc, seed=None, skew=1.0, gen_probs=GEN_PROBS, no_auth=0.05,
+                 p_circ=0.8, p_taken=0.5, mean_circ=3.0):
+        self.rng = np.random.default_rng(seed)
+        self.lcc_prefixes, self.lcc_mins, self.lcc_maxs = lcc_candidates(lcc)
+        self.ddc_labels = ddc_candidates(ddc)
+        self.lcc_weights = self.category_weights(len(self.lcc_prefixes), skew)
+        self.ddc_weights = self.category_weights(len(self.ddc_labels), skew)
+        self.gen_probs = np.asarray(gen_probs) / np.sum(gen_probs)
+        self.no_auth = no_auth
+        self.p_circ = p_circ
+        self.p_taken = p_taken
+        self.mean_circ = mean_circ
+        # next OCLC number to hand out
+        self.next_oclc = 0
+
+    def category_weights(self, n, skew):
+        weights = self.rng.lognormal(0, skew, size=n)
+        return weights / weights.sum()
+
+    '''
+    Sample n books as columns: a dict of arrays (or lists for the
+    classification numbers) with one entry per book
+    '''
+    def sample_columns(self, n):
+        rng = self.rng
+        lcc_idx = rng.choice(len(self.lcc_prefixes), size=n, p=self.lcc_weights)
+        vals = rng.uniform(self.lcc_mins[lcc_idx], self.lcc_maxs[lcc_idx])
+        ddc_idx = rng.choice(len(self.ddc_labels), size=n, p=self.ddc_weights)
+        gender = rng.choice(len(lt.GENDERS), size=n, p=self.gen_probs).astype(np.int8)
+        gender[rng.random(n) < self.no_auth] = -1
+        circ_status = (rng.random(n) < self.p_circ).astype(np.int64)
+        taken = (circ_status == 1) & (rng.random(n) < self.p_taken)
+        total_circ = np.where(taken, rng.geometric(1 / self.mean_circ, size=n), 0)
+        oclc = np.arange(self.next_oclc, self.next_oclc + n, dtype=np.int64)
+        self.next_oclc += n
+        return {'oclc': oclc,
+                'lcc': format_lcc(rng, self.lcc_prefixes[lcc_idx], vals,
+                                  self.lcc_mins[lcc_idx], self.lcc_maxs[lcc_idx]),
+                'ddc': format_ddc(rng, self.ddc_labels[ddc_idx]),
+                'gender': gender,
+                'total_circ': total_circ,
+                'circ_status': circ_status}
+
+    '''
+    Sample n books as a list of book dicts
+    '''
+    def sample(self, n):
+        return to_books(self.sample_columns(n))
+
+'''
+Convert sampled columns into a list of book dicts
+'''
+def to_books(columns):
+    books = []
+    for oclc, lcc, ddc, gen, total, status in zip(columns['oclc'].tolist(), columns['lcc'],
+                                                  columns['ddc'], columns['gender'].tolist(),
+                                                  columns['total_circ'].tolist(),
+                                                  columns['circ_status'].tolist()):
+        books.append({'oclc': oclc,
+                      'lcc': lcc,
+                      'ddc': ddc,
+                      'auth': [] if gen == -1 else [f'Author {oclc}'],
+                      'auth_gen': None if gen == -1 else lt.GENDERS[gen],
+                      'total_circ': total,
+                      'circ_status': status})
+    return books
+
+'''
+Generate a synthetic catalogue of n books
+'''
+def make_catalogue(lcc, ddc, n, seed=None, **kwargs):
+    return CatalogueSampler(lcc, ddc, seed, **kwargs).sample(n)
+
+'''
+Generate a synthetic catalogue of n books in chunks of at most chunk books,
+so that large catalogues (i.e. 10^7 books) can be streamed
+'''
+def iter_catalogue(lcc, ddc, n, chunk=100000, seed=None, **kwargs):
+    sampler = CatalogueSampler(lcc, ddc, seed, **kwargs)
+    done = 0
+    while done < n:
+        size = min(chunk, n - done)
+        yield sampler.sample(size)
+        done += size
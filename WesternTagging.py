@@ -2,6 +2,16 @@
 Helper code for tagging Library of Congress and Dewey Decimal nodes as western or non-western
 based on a pre-defined set of starting nodes. 
 '''
+import os
+import itertools
+import numpy as np
+from LibraryTree import Node, TreeIndex
+import Instrument as inst
+
+# Tagging schemes used in the paper (the same assignments as tag_lcc and tag_dewey)
+TAG_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Category Tags')
+LCC_TAGS = os.path.join(TAG_FOLDER, 'LCC Category Tags.txt')
+DDC_TAGS = os.path.join(TAG_FOLDER, 'DDC Category Tags.txt')
 
 # Collect nodes in a subtree that are either western, non-western or neither.
 # If west is True nodes are western, if west is False they are non-western,
@@ -13,6 +23,9 @@ def parse_west_data(root, west, data):
                      'num_desc': root.count_descendants(),
                      'depth': root.depth,
                      'num_items': root.item_count,
+                     'total_circ': root.total_circ,
+                     'num_in_circ': root.num_in_circ,
+                     'circ_year': root.circ_year,
                      'western': root.west,
                      'parent': root.parent,
                      'items': root.items})
@@ -20,6 +33,109 @@ def parse_west_data(root, west, data):
         if child is not None:
             parse_west_data(child, west, data)
 
+# Column view of the nodes collected by parse_west_view. Each field of the 
+# dicts built by parse_west_data is stored as an array with one entry per node 
+# ('depth', 'num_desc', 'num_items', 'total_circ', 'num_in_circ', 'circ_year').
+# 'western' codes the west flag as 1 (western), 0 (non-western) or -1 (neither)
+# and 'start' marks starting nodes (nodes whose parent is not tagged).
+class TaggedNodes:
+    FIELDS = ['depth', 'num_desc', 'num_items', 'total_circ', 'num_in_circ',
+              'circ_year', 'western', 'start']
+
+    def __init__(self, nodes, columns):
+        self.nodes = nodes
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __getitem__(self, field):
+        return self.columns[field]
+
+    # Combine the nodes of two views (i.e. to pool several domains)
+    def __add__(self, other):
+        if isinstance(other, list) and other == []:
+            return self
+        if not isinstance(other, TaggedNodes):
+            return NotImplemented
+        nodes = np.concatenate((self.nodes, other.nodes))
+        columns = {field: np.concatenate((self.columns[field], other.columns[field]))
+                   for field in self.FIELDS}
+        return TaggedNodes(nodes, columns)
+
+    # Allows sum(views, []) and sum(views) to pool a list of views
+    def __radd__(self, other):
+        if (isinstance(other, list) and other == []) or other == 0:
+            return self
+        return NotImplemented
+
+    # Subset of the view selected by a boolean mask
+    def subset(self, mask):
+        return TaggedNodes(self.nodes[mask], {field: col[mask] for field, col 
+                                              in self.columns.items()})
+
+    # The starting nodes in the view
+    def starting(self):
+        return self.subset(self.columns['start'])
+
+    # The western (west=True), non-western (west=False) or untagged
+    # (west=None) nodes in the view
+    def select(self, west):
+        return self.subset(self.columns['western'] == west_code(west))
+
+# Code a west flag as an integer
+def west_code(west):
+    if west is None:
+        return -1
+    return int(west)
+
+# Collect the nodes in one or more subtrees that are either western, non-western 
+# or neither into a TaggedNodes view. Unlike parse_west_data this visits 
+# each node once and counts descendants from the layout of the subtree.
+# index is the TreeIndex of the whole tree (tree.get_index()); subtrees are
+# then slices of its cached layout instead of being laid out on every call.
+@inst.timed('west.parse_west_view')
+def parse_west_view(roots, west, index=None):
+    if isinstance(roots, Node):
+        roots = [roots]
+    views = []
+    for root in roots:
+        if index is None or id(root) not in index.positions:
+            layout, first = TreeIndex(root), 0
+        else:
+            layout, first = index, index.position(root)
+        last = int(layout.end[first])
+        sub_nodes = layout.nodes[first:last]
+        n = last - first
+        tags = np.fromiter((west_code(node.west) for node in sub_nodes), dtype=np.int8, count=n)
+        # the root of the subtree is a starting node if its own parent is untagged
+        parents = layout.parent[first:last] - first
+        parents[0] = 0
+        parent_tags = tags[parents]
+        parent_tags[0] = -1 if root.parent is None else west_code(root.parent.west)
+        mask = tags == west_code(west)
+        nodes = np.empty(n, dtype=object)
+        nodes[:] = sub_nodes
+        columns = {'depth': layout.depth[first:last],
+                   'num_desc': layout.end[first:last] - np.arange(first, last) - 1,
+                   'western': tags,
+                   'start': parent_tags == -1}
+        for field, attr in [('num_items', 'item_count'), ('total_circ', 'total_circ'),
+                            ('num_in_circ', 'num_in_circ'), ('circ_year', 'circ_year')]:
+            columns[field] = np.fromiter((getattr(node, attr) for node in sub_nodes),
+                                         dtype=np.int64, count=n)
+        views.append(TaggedNodes(nodes, columns).subset(mask))
+    if views == []:
+        return empty_view()
+    return sum(views[1:], views[0])
+
+# A view without any nodes
+def empty_view():
+    columns = {field: np.zeros(0, dtype=np.int64) for field in TaggedNodes.FIELDS}
+    columns['western'] = np.zeros(0, dtype=np.int8)
+    columns['start'] = np.zeros(0, dtype=bool)
+    return TaggedNodes(np.empty(0, dtype=object), columns)
+
 # Function to tag a starting node and its children as western
 # or non-western
 def label(root, flag):
@@ -29,6 +145,7 @@ def label(root, flag):
             label(child, flag)
 
 # Western non-western tagging assignments
+@inst.timed('west.tag_lcc')
 def tag_lcc(tree):
     # RELIGION
     # Christianity
@@ -227,6 +344,7 @@ def tag_lcc(tree):
     label(root, False)
 
 
+@inst.timed('west.tag_dewey')
 def tag_dewey(tree):
     # HISTORY
     # British Isles
@@ -533,3 +651,132 @@ def tag_dewey(tree):
     # Other lit
     node = tree.get_node('899')
     label(node, False)
+
+
+# DATA-DRIVEN TAGGING
+# Tagging schemes can also be read from text files like the ones in 
+# 'Category Tags'. Entries are lines of the form '<label>: <name>' listed
+# under a 'WESTERN' or 'NON-WESTERN' heading, where the label is an LCC
+# label (i.e. 'BM', 'BL689-980', 'E') or a DDC number (i.e. '299.936'). 
+# Other lines (domain headings, rules, blank lines) are ignored.
+
+# Read a tagging scheme file into a list of (label, west, name) entries in
+# file order
+def read_tag_spec(fp):
+    spec = []
+    west = None
+    with open(fp, 'r', encoding='utf8') as f:
+        for line in f:
+            line = line.strip()
+            if line == 'WESTERN':
+                west = True
+            elif line == 'NON-WESTERN':
+                west = False
+            elif ':' in line and west is not None:
+                label, name = line.split(':', 1)
+                spec.append((label.strip(), west, name.strip()))
+    return spec
+
+# Resolve every entry of a tagging scheme to its node's preorder interval
+# in the tree's index. Returns an array of (start, end, west code) rows 
+# which can be applied to the tree any number of times.
+def compile_tags(tree, spec):
+    index = tree.get_index()
+    intervals = []
+    for label, west, _ in spec:
+        start = index.position(tree.get_node(label))
+        intervals.append((start, index.end[start], west_code(west)))
+    return np.array(intervals, dtype=np.int64).reshape(-1, 3)
+
+# Write compiled tags into a tag column with one entry per node (in the 
+# preorder of the tree's index). Later entries override earlier ones, as 
+# with repeated calls to label(). Untagged nodes are -1.
+def apply_tags(num_nodes, intervals):
+    tags = np.full(num_nodes, -1, dtype=np.int8)
+    for start, end, code in intervals.tolist():
+        tags[start:end] = code
+    return tags
+
+# Copy a tag column onto the west attribute of the nodes of a tree, for 
+# use with parse_west_data, parse_west_view and CategoryBias
+def set_west(tree, tags):
+    flags = {-1: None, 0: False, 1: True}
+    for node, code in zip(tree.get_index().nodes, tags.tolist()):
+        node.west = flags[code]
+
+# Tag a tree with a tagging scheme file. Returns the tag column.
+@inst.timed('west.tag_from_file')
+def tag_from_file(tree, fp):
+    intervals = compile_tags(tree, read_tag_spec(fp))
+    tags = apply_tags(len(tree.get_index()), intervals)
+    set_west(tree, tags)
+    return tags
+
+
+# SENSITIVITY TO THE TAGGING SCHEME
+# Several tagging schemes can be held at once as a tag matrix with one row 
+# per node (in the preorder of the tree's index) and one column per scheme.
+
+# Build a tag matrix from a list of tagging schemes (lists of entries as
+# returned by read_tag_spec)
+def tag_matrix(tree, specs):
+    num_nodes = len(tree.get_index())
+    return np.stack([apply_tags(num_nodes, compile_tags(tree, spec)) for spec in specs], 
+                    axis=1)
+
+# Generate every variant of a tagging scheme in which the debatable entries
+# in labels (i.e. ['BM', 'DK']) are tagged western or non-western (or, if 
+# untag is True, left untagged). The first variant is the original scheme.
+# Every label must be an entry of the scheme.
+def spec_variants(spec, labels, untag=False):
+    options = [True, False] + ([None] if untag else [])
+    current = {label: west for label, west, _ in spec}
+    for label in labels:
+        if label not in current:
+            raise ValueError(f'{label} is not an entry of the tagging scheme')
+    # put the original assignment of each label first
+    choices = [[current[label]] + [opt for opt in options if opt is not current[label]] 
+               for label in labels]
+    variants = []
+    for combo in itertools.product(*choices):
+        flags = dict(zip(labels, combo))
+        variants.append([(label, flags.get(label, west), name) for label, west, name in spec
+                         if flags.get(label, west) is not None])
+    return variants
+
+# Collect the fields used by the category bias metrics for every node of a
+# tree's index (see TaggedNodes.FIELDS)
+def node_columns(index):
+    nodes = np.empty(len(index), dtype=object)
+    nodes[:] = index.nodes
+    return nodes, {'depth': index.depth,
+                   'num_desc': index.num_descendants(),
+                   'num_items': index.column('item_count'),
+                   'total_circ': index.column('total_circ'),
+                   'num_in_circ': index.column('num_in_circ'),
+                   'circ_year': index.column('circ_year')}
+
+# Mask of the nodes of a tree's index within the subtrees of a list of roots
+def domain_mask(index, roots):
+    mask = np.zeros(len(index), dtype=bool)
+    for root in roots:
+        start = index.position(root)
+        mask[start:index.end[start]] = True
+    return mask
+
+# Starting node masks of every scheme of a tag matrix: tagged nodes whose
+# parent is untagged
+def start_matrix(index, tags):
+    parent_tags = tags[np.maximum(index.parent, 0)]
+    parent_tags[index.parent < 0] = -1
+    return (tags != -1) & (parent_tags == -1)
+
+# Build a TaggedNodes view of the western (west=True) or non-western 
+# (west=False) nodes of one column of a tag matrix, restricted to a domain 
+# mask. node_cols are the columns returned by node_columns.
+def scheme_view(index, tags, west, domain, node_cols):
+    nodes, columns = node_cols
+    starts = start_matrix(index, tags[:, None])[:, 0]
+    mask = (tags == west_code(west)) & domain
+    columns = {**columns, 'western': tags, 'start': starts}
+    return TaggedNodes(nodes, columns).subset(mask)